@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+import boto3
+import logging
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fastfix.clients import log_stats
+from fastfix.fixes import FIXES, load_fix
+from fastfix.pool import run_logged
+from fastfix.s3posture import share_postures
+
+# These fixes look at the same buckets, so when they run together they share the bucket list and posture calls
+S3_FIXES = ['s3-public-access', 's3-encryption']
+
+
+def main(args, fixes, logger):
+    '''Executes the Primary Logic'''
+
+    if args.command == 'list':
+        for name, script in FIXES.items():
+            print(f"{name:20} {script}")
+        return(True)
+
+    # If they specify a profile use it. Otherwise do the normal thing
+    if args.profile:
+        session = boto3.Session(profile_name=args.profile)
+    else:
+        session = boto3.Session()
+
+    # Every fix shares the session, and with it the region list and the clients for each region (see fastfix.regions)
+    s3_fixes = [name for name in fixes if name in S3_FIXES]
+    if len(s3_fixes) > 1:
+        share_postures(session, max(fixes[name][1].max_workers for name in s3_fixes))
+    results = run_logged(lambda name, fix_logger: run_fix(fixes[name], session, fix_logger), list(fixes), logger, args.max_fixes)
+
+    failed = [name for name, result, error, seconds in results if error is not None]
+    for name, result, error, seconds in results:
+        logger.info(f"{name}: {'failed' if error is not None else 'done'} in {round(seconds, 1)} seconds")
+    return(not failed)
+
+
+def run_fix(fix_and_args, session, logger):
+    '''Run one fix with the shared session'''
+    fix, fix_args = fix_and_args
+    # Some fixes use the args & logger their __main__ would have set up
+    fix.args = fix_args
+    fix.logger = logger
+    return(fix.main(fix_args, logger, session=session))
+
+
+def do_args():
+    import argparse
+    parser = argparse.ArgumentParser(description="Run several fast fixes in one process, sharing the session, regions and clients")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list', help="List the fixes that can be run")
+    run = subparsers.add_parser('run', help="Run the given fixes. Any other options are passed to every fix that knows them",
+                                usage="%(prog)s [-h] [--debug] [--error] [--timestamp] [--profile PROFILE] [--max-fixes MAX_FIXES] FIX [FIX ...] [fix options]")
+    run.add_argument("--debug", help="print debugging info", action='store_true')
+    run.add_argument("--error", help="print error info only", action='store_true')
+    run.add_argument("--timestamp", help="Output log with timestamp and toolname", action='store_true')
+    run.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials)")
+    run.add_argument("--max-fixes", help="Number of fixes to run in parallel. Default is all of them", type=int, default=len(FIXES))
+    run.add_argument("fixes", nargs='+', metavar='FIX', choices=list(FIXES), help=f"Fixes to run, from: {', '.join(FIXES)}")
+
+    # Whatever we don't know is an option for the fixes
+    args, fix_argv = parser.parse_known_args()
+
+    # Load each fix once and parse its options up front, so a mistake fails now rather than half way through the run
+    fixes = {}
+    unrecognized = None
+    for name in dict.fromkeys(getattr(args, 'fixes', [])):
+        fix = load_fix(name)
+        fix_args, leftovers = fix.do_args(fix_argv, known_only=True)
+        fixes[name] = (fix, fix_args)
+        unrecognized = [arg for arg in leftovers if unrecognized is None or arg in unrecognized]
+    if unrecognized:
+        # Nothing we are running knows these, so they are most likely a typo (like --actualy-do-it)
+        run.error(f"unrecognized arguments: {' '.join(unrecognized)}")
+
+    return(args, fixes)
+
+if __name__ == '__main__':
+
+    args, fixes = do_args()
+
+    # Logging idea stolen from: https://docs.python.org/3/howto/logging.html#configuring-logging
+    # create console handler and set level to debug
+    logger = logging.getLogger('aws-fast-fixes')
+    ch = logging.StreamHandler()
+    if getattr(args, 'debug', False):
+        logger.setLevel(logging.DEBUG)
+    elif getattr(args, 'error', False):
+        logger.setLevel(logging.ERROR)
+    else:
+        logger.setLevel(logging.INFO)
+
+    # Silence Boto3 & Friends
+    logging.getLogger('botocore').setLevel(logging.WARNING)
+    logging.getLogger('boto3').setLevel(logging.WARNING)
+    logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+    # create formatter. The logger name says which fix a line is from
+    if getattr(args, 'timestamp', False):
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    else:
+        formatter = logging.Formatter('%(levelname)s - %(name)s - %(message)s')
+    # add formatter to ch
+    ch.setFormatter(formatter)
+    # add ch to logger
+    logger.addHandler(ch)
+
+    try:
+        ok = main(args, fixes, logger)
+        log_stats(logger)
+        if not ok:
+            exit(1)
+    except KeyboardInterrupt:
+        exit(1)
@@ -4,81 +4,112 @@ import boto3
 from botocore.exceptions import ClientError
 import logging
 import os
-
-max_workers = 10
-
-def main(args, logger):
+import sys
+from collections import defaultdict
+from functools import partial
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fastfix.clients import log_stats
+from fastfix.regions import run_regions, region_resource, describe_regions, in_region
+from fastfix.depgraph import run_graph
+
+def main(args, logger, session=None):
     '''Executes the Primary Logic'''
 
-    session = boto3.Session(profile_name=args.profile, region_name=args.boto_region)
+    # If we were handed a session (see org-wide/run-org-wide.py) use it
+    if session is None:
+        session = boto3.Session(profile_name=args.profile, region_name=args.boto_region)
 
     # Get all the Regions for this account
     all_regions = get_regions(session, args)
 
-    # processiong regions
-    for region in all_regions:
-        process_region(args, region, session, logger)
+    # processiong regions in parallel
+    run_regions(lambda region: process_region(args, region, session, logger), all_regions, logger, args.max_workers)
 
     return
 
-def delete_igw(vpc,logger):
-    for igw in vpc.internet_gateways.all():
-        logger.debug("Detaching {}, VPC:{}".format(igw.id,vpc.id))
-        igw.detach_from_vpc(VpcId=vpc.id)
-        logger.debug("Deleting {}, VPC:{}".format(igw.id,vpc.id))
-        igw.delete()
-
-def delete_eigw(vpc,logger):
-    client = vpc.meta.client
+def get_igws(vpc,inventory):
+    return(vpc.internet_gateways.all())
+
+def detach_igw(igw_id,client,vpc_id,logger):
+    logger.debug("Detaching {}, VPC:{}".format(igw_id,vpc_id))
+    client.detach_internet_gateway(InternetGatewayId=igw_id, VpcId=vpc_id)
+
+def delete_igw(igw_id,client,vpc_id,logger):
+    logger.debug("Deleting {}, VPC:{}".format(igw_id,vpc_id))
+    client.delete_internet_gateway(InternetGatewayId=igw_id)
+
+def get_region_inventory(client):
+    '''Describe the region's egress-only internet gateways, VPN gateways and VPN connections once,
+    indexed by the VpcId (or VpnGatewayId) they belong to, rather than once per VPC'''
+    inventory = {
+        'egress_only_internet_gateways': defaultdict(list),
+        'virtual_private_gateways': defaultdict(list),
+        'vpn_connections': defaultdict(list),
+    }
     paginator = client.get_paginator('describe_egress_only_internet_gateways')
     for page in paginator.paginate():
         for eigw in page['EgressOnlyInternetGateways']:
             for attachment in eigw['Attachments']:
-                if attachment['VpcId'] == vpc.id and attachment['State'] == 'attached':
-                    logger.debug("Deleting {}, VPC:{}".format(eigw['EgressOnlyInternetGatewayId'],vpc.id))
-                    client.delete_egress_only_internet_gateway(EgressOnlyInternetGatewayId=eigw['EgressOnlyInternetGatewayId'])
-                    break
-
-def delete_subnet(vpc,logger):
-    for subnet in vpc.subnets.all():
-        logger.debug("Deleting {}, VPC:{}".format(subnet.id,vpc.id))
-        subnet.delete()
-
-def delete_sg(vpc,logger):
-    for sg in filter(lambda x:x.group_name != 'default', vpc.security_groups.all()): #exclude default SG:
-        logger.debug("Deleting {}, VPC:{}".format(sg.id,vpc.id))
-        sg.delete()
-
-def delete_rtb(vpc,logger):
+                if attachment['State'] == 'attached':
+                    inventory['egress_only_internet_gateways'][attachment['VpcId']].append(eigw['EgressOnlyInternetGatewayId'])
+
+    response = client.describe_vpn_gateways(Filters=[{'Name': 'state', 'Values': ['pending', 'available']}])
+    for vgw in response['VpnGateways']:
+        for VpcId in set(attachment['VpcId'] for attachment in vgw['VpcAttachments']):
+            inventory['virtual_private_gateways'][VpcId].append(vgw)
+
+    response = client.describe_vpn_connections(Filters=[{'Name': 'state', 'Values': ['pending', 'available']}])
+    for vpn_connection in response['VpnConnections']:
+        if vpn_connection.get('VpnGatewayId'):
+            inventory['vpn_connections'][vpn_connection['VpnGatewayId']].append(vpn_connection)
+    return(inventory)
+
+def get_eigws(vpc,inventory):
+    return(inventory['egress_only_internet_gateways'].get(vpc.id, []))
+
+def delete_eigw(eigw_id,client,vpc_id,logger):
+    logger.debug("Deleting {}, VPC:{}".format(eigw_id,vpc_id))
+    client.delete_egress_only_internet_gateway(EgressOnlyInternetGatewayId=eigw_id)
+
+def delete_subnet(subnet_id,client,vpc_id,logger):
+    logger.debug("Deleting {}, VPC:{}".format(subnet_id,vpc_id))
+    client.delete_subnet(SubnetId=subnet_id)
+
+def get_sgs(vpc,inventory):
+    return(filter(lambda x:x.group_name != 'default', vpc.security_groups.all())) #exclude default SG
+
+def delete_sg(sg_id,client,vpc_id,logger):
+    logger.debug("Deleting {}, VPC:{}".format(sg_id,vpc_id))
+    client.delete_security_group(GroupId=sg_id)
+
+def get_rtbs(vpc,inventory):
     for rtb in vpc.route_tables.all():
-        rt_is_main = False
         # skip deleting main route tables
-        for attr in rtb.associations_attribute:
-            if attr['Main']:
-                rt_is_main = True
-        if rt_is_main:
-            continue
-        logger.debug("Deleting {}, VPC:{}".format(rtb.id,vpc.id))
-        rtb.delete()
+        if not any(attr['Main'] for attr in rtb.associations_attribute):
+            yield(rtb)
 
-def delete_acl(vpc,logger):
-    for acl in vpc.network_acls.all():
-        if acl.is_default:
-            # skip deleting default acl
-            continue
-        logger.debug("Deleting {}, VPC:{}".format(acl.id,vpc.id))
-        acl.delete()
+def delete_rtb(rtb_id,client,vpc_id,logger):
+    logger.debug("Deleting {}, VPC:{}".format(rtb_id,vpc_id))
+    client.delete_route_table(RouteTableId=rtb_id)
 
-def delete_pcx(vpc,logger):
+def get_acls(vpc,inventory):
+    # skip deleting default acl
+    return(filter(lambda x:not x.is_default, vpc.network_acls.all()))
+
+def delete_acl(acl_id,client,vpc_id,logger):
+    logger.debug("Deleting {}, VPC:{}".format(acl_id,vpc_id))
+    client.delete_network_acl(NetworkAclId=acl_id)
+
+def get_pcxs(vpc,inventory):
     pcxs = list(vpc.accepted_vpc_peering_connections.all()) + list(vpc.requested_vpc_peering_connections.all())
-    for pcx in pcxs:
-        if pcx.status['Code'] == 'deleted':
-            # vpc peering connections already deleted
-            continue
-        logger.debug("Deleting {}, VPC:{}".format(pcx.status,vpc.id))
-        pcx.delete()
+    # skip vpc peering connections already deleted
+    return([pcx for pcx in pcxs if pcx.status['Code'] != 'deleted'])
 
-def delete_endpoints(vpc,logger):
+def delete_pcx(pcx_id,client,vpc_id,logger):
+    logger.debug("Deleting {}, VPC:{}".format(pcx_id,vpc_id))
+    client.delete_vpc_peering_connection(VpcPeeringConnectionId=pcx_id)
+
+def get_endpoints(vpc,inventory):
     client = vpc.meta.client
     paginator = client.get_paginator('describe_vpc_endpoints')
     for page in paginator.paginate(Filters=[
@@ -86,8 +117,11 @@ def delete_endpoints(vpc,logger):
                     {'Name': 'vpc-endpoint-state', 'Values': ['pendingAcceptance', 'pending', 'available', 'rejected', 'failed']},
                 ]):
         for endpoint in page['VpcEndpoints']:
-            logger.debug("Deleting {}, VPC:{}".format(endpoint['VpcEndpointId'],vpc.id))
-            client.delete_vpc_endpoints(VpcEndpointIds=[endpoint['VpcEndpointId']])
+            yield(endpoint['VpcEndpointId'])
+
+def delete_endpoint(endpoint_id,client,vpc_id,logger):
+    logger.debug("Deleting {}, VPC:{}".format(endpoint_id,vpc_id))
+    client.delete_vpc_endpoints(VpcEndpointIds=[endpoint_id])
 
 def delete_cvpn_endpoint(vpc,logger):
     client = vpc.meta.client
@@ -98,64 +132,119 @@ def delete_cvpn_endpoint(vpc,logger):
                 logger.debug("Deleting {}, VPC:{}".format(cvpn_endpoint['ClientVpnEndpointId'],vpc.id))
                 client.delete_client_vpn_endpoint(ClientVpnEndpointId=[cvpn_endpoint['ClientVpnEndpointId']])
 
-def delete_vgw(vpc,logger):
-    client = vpc.meta.client
-    response = client.describe_vpn_gateways(Filters=[
-                    {'Name': 'attachment.vpc-id', 'Values': [vpc.id]},
-                    {'Name': 'state', 'Values': ['pending', 'available']},
-                ])
-    for vgw in response['VpnGateways']:
-        for attachment in vgw['VpcAttachments']:
-            if attachment['State'] in ['attaching','attached']:
-                logger.debug("Detaching {}, from VPC:{}".format(vgw['VpnGatewayId'],vpc.id))
-                client.detach_vpn_gateway(VpcId=vpc.id, VpnGatewayId=vgw['VpnGatewayId'])
-                break
-        response = client.describe_vpn_connections(Filters=[{'Name': 'vpn-gateway-id', 'Values': [vgw['VpnGatewayId']]}])
-        for vpn_connection in response['VpnConnections']:
-            if vpn_connection['State'] in ['pending','available']:
-                logger.debug("Deleting {}, from VPC:{}".format(vpn_connection['VpnConnectionId'],vpc.id))
-                client.delete_vpn_connection(VpnConnectionId=vpn_connection['VpnConnectionId'])
-        logger.debug("Deleting {}, VPC:{}".format(vgw['VpnGatewayId'],vpc.id))
-        client.delete_vpn_gateway(VpnGatewayId=vgw['VpnGatewayId'])
-
-def delete_vpc(vpc,logger,region,debug):
-    network_interfaces = list(vpc.network_interfaces.all())
-    if network_interfaces:
+def get_vgws(vpc,inventory):
+    return(inventory['virtual_private_gateways'].get(vpc.id, []))
+
+def get_attached_vgws(vpc,inventory):
+    return([vgw for vgw in get_vgws(vpc, inventory) if any(a['State'] in ['attaching','attached'] for a in vgw['VpcAttachments'])])
+
+def detach_vgw(vgw_id,client,vpc_id,logger):
+    logger.debug("Detaching {}, from VPC:{}".format(vgw_id,vpc_id))
+    client.detach_vpn_gateway(VpcId=vpc_id, VpnGatewayId=vgw_id)
+
+def get_vpn_connections(vpc,inventory):
+    # Only the ones still pending or available are in the inventory
+    return([vpn_connection for vgw in get_vgws(vpc, inventory) for vpn_connection in inventory['vpn_connections'].get(vgw['VpnGatewayId'], [])])
+
+def delete_vpn_connection(vpn_connection_id,client,vpc_id,logger):
+    logger.debug("Deleting {}, from VPC:{}".format(vpn_connection_id,vpc_id))
+    client.delete_vpn_connection(VpnConnectionId=vpn_connection_id)
+
+def delete_vgw(vgw_id,client,vpc_id,logger):
+    logger.debug("Deleting {}, VPC:{}".format(vgw_id,vpc_id))
+    client.delete_vpn_gateway(VpnGatewayId=vgw_id)
+
+# What to delete in a VPC: for each kind of resource (or step, like detaching a gateway), how to find them,
+# how to do it to one (given its id, an EC2 client, and the VpcId), and the kinds that have to be done before it can be.
+# Each step is a single call, so retrying one on DependencyViolation never repeats something that already worked.
+# dependency order from https://aws.amazon.com/premiumsupport/knowledge-center/troubleshoot-dependency-error-delete-vpc/
+VPC_RESOURCES = {
+    'internet_gateway_attachments': (get_igws, detach_igw, []),
+    'internet_gateways': (get_igws, delete_igw, ['internet_gateway_attachments']),
+    'egress_only_internet_gateways': (get_eigws, delete_eigw, []),
+    'vpc_endpoints': (get_endpoints, delete_endpoint, []),
+    'vpc_peering_connections': (get_pcxs, delete_pcx, []),
+    'vpn_gateway_attachments': (get_attached_vgws, detach_vgw, []),
+    'vpn_connections': (get_vpn_connections, delete_vpn_connection, []),
+    'virtual_private_gateways': (get_vgws, delete_vgw, ['vpn_gateway_attachments', 'vpn_connections']),
+    # nat gateways (we do not delete this for safety)
+    # instances (we do not delete this for safety)
+    # client vpn endpoints, skip deleting because it use network interfaces
+    # network interfaces (we do not delete this for safety)
+    'subnets': (lambda vpc, inventory: vpc.subnets.all(), delete_subnet, ['vpc_endpoints']),
+    'route_tables': (get_rtbs, delete_rtb, ['subnets']),
+    'network_acls': (get_acls, delete_acl, ['subnets']),
+    'security_groups': (get_sgs, delete_sg, ['vpc_endpoints']),
+}
+
+def resource_id(resource):
+    if isinstance(resource, str):
+        return(resource)
+    if isinstance(resource, dict):
+        return(resource.get('VpnConnectionId') or resource['VpnGatewayId'])
+    return(resource.id)
+
+def get_teardown_graph(vpc,inventory,logger):
+    '''Return the tasks to delete vpc and everything in it, and what each task depends on, for run_graph().
+    inventory is the region's slice of things we don't look up per VPC, from get_region_inventory()'''
+    tasks = {}
+    kinds = {}
+    found = {}
+    for kind, (get_resources, delete_resource, _) in VPC_RESOURCES.items():
+        # Detaching and deleting a gateway are separate steps, but there is no need to look the gateways up twice
+        if get_resources not in found:
+            found[get_resources] = list(get_resources(vpc, inventory))
+        for resource in found[get_resources]:
+            name = f"{kind}:{resource_id(resource)}"
+            # The tasks run on run_graph()'s threads, so they only get ids and the (thread safe) client, not boto3
+            # resource objects, and what they log is kept with the rest of this region's output
+            tasks[name] = in_region(partial(delete_resource, resource_id(resource), vpc.meta.client, vpc.id, logger))
+            kinds[name] = kind
+
+    deps = {}
+    for name, kind in kinds.items():
+        deps[name] = [other for other, other_kind in kinds.items() if other_kind in VPC_RESOURCES[kind][2]]
+    # The VPC goes last
+    tasks['vpc'] = in_region(partial(vpc.meta.client.delete_vpc, VpcId=vpc.id))
+    deps['vpc'] = list(kinds)
+    return(tasks, deps)
+
+def has_network_interfaces(vpc):
+    '''Return True if vpc has any ENIs. We only need to know if there are any, so ask for the smallest pages allowed.
+    A filtered page can come back empty with more to follow, so keep going until we find one or run out of pages'''
+    paginator = vpc.meta.client.get_paginator('describe_network_interfaces')
+    for page in paginator.paginate(Filters=[{'Name': 'vpc-id', 'Values': [vpc.id]}], PaginationConfig={'PageSize': 5}):
+        if page['NetworkInterfaces']:
+            return(True)
+    return(False)
+
+def get_network_interfaces(vpc):
+    '''Yield the ENIs in vpc a page at a time'''
+    paginator = vpc.meta.client.get_paginator('describe_network_interfaces')
+    for page in paginator.paginate(Filters=[{'Name': 'vpc-id', 'Values': [vpc.id]}]):
+        for eni in page['NetworkInterfaces']:
+            yield(eni)
+
+def delete_vpc(vpc,inventory,logger,region,debug):
+    if has_network_interfaces(vpc):
         logger.warning("Elastic Network Interfaces exist in the VPC:{}, skipping delete".format(vpc.id))
         if debug:
-            for eni in network_interfaces:
-                logger.debug("Interface:{} attached to {},  VPC:{}, region:{}".format(eni.id,eni.attachment,vpc.id,region))
+            for eni in get_network_interfaces(vpc):
+                logger.debug("Interface:{} attached to {},  VPC:{}, region:{}".format(eni['NetworkInterfaceId'],eni.get('Attachment'),vpc.id,region))
         return
     else:
         logger.info("Deleting default VPC:{}, region:{}".format(vpc.id,region))
         if args.actually_do_it:
-            try:
-                vpc_resources = {
-                    # dependency order from https://aws.amazon.com/premiumsupport/knowledge-center/troubleshoot-dependency-error-delete-vpc/
-                    'internet_gateways': delete_igw,
-                    'egress_only_internet_gateways': delete_eigw,
-                    'subnets': delete_subnet,
-                    'route_tables': delete_rtb,
-                    'network_acls': delete_acl,
-                    'vpc_peering_connections': delete_pcx,
-                    'vpc_endpoints': delete_endpoints,
-                    # nat gateways (we do not delete this for safety)
-                    'security_groups': delete_sg,
-                    # instances (we do not delete this for safety)
-                    # 'client_vpn_endpoints': delete_cvpn_endpoint, skip deleting because it use network interfaces
-                    'virtual_private_gateways': delete_vgw,
-                    # network interfaces (we do not delete this for safety)
-                }
-                for resource_type in vpc_resources:
-                    vpc_resources[resource_type](vpc,logger)
-
-                vpc.delete()
-
-            except ClientError as e:
-                if e.response['Error']['Code'] == 'DependencyViolation':
-                    logger.error("VPC:{} can't be delete due to dependency, {}".format(vpc.id, e))
-                else:
-                    raise
+            # Resources that don't depend on each other are deleted at the same time
+            tasks, deps = get_teardown_graph(vpc,inventory,logger)
+            failed, skipped = run_graph(tasks, deps, max_workers=args.teardown_workers)
+            for name, e in failed.items():
+                if not isinstance(e, ClientError) or e.response['Error']['Code'] != 'DependencyViolation':
+                    raise e
+                logger.error("{} can't be deleted due to dependency, VPC:{}, {}".format(name, vpc.id, e))
+            if failed or skipped:
+                logger.error("VPC:{} can't be delete due to dependency".format(vpc.id))
+                return
 
             logger.info("Successfully deleted default VPC:{}, region:{}".format(vpc.id,region))
         if not args.actually_do_it:
@@ -163,7 +252,7 @@ def delete_vpc(vpc,logger,region,debug):
 
 def process_region(args, region, session, logger):
     logger.info(f"Processing region {region}")
-    ec2_resource = session.resource('ec2', region_name=region)
+    ec2_resource = region_resource(session, 'ec2', region)
 
     vpcs = []
     for vpc in ec2_resource.vpcs.filter(Filters=[{'Name': 'isDefault', 'Values': ['true']}]):
@@ -174,8 +263,9 @@ def process_region(args, region, session, logger):
         else:
             vpcs.append(vpc)
     if vpcs:
+        inventory = get_region_inventory(ec2_resource.meta.client) if args.actually_do_it else None
         for vpc in vpcs:
-            delete_vpc(vpc,logger,region,args.debug)
+            delete_vpc(vpc,inventory,logger,region,args.debug)
     else:
         logger.debug("No Default VPC to to be deleted in region:{}".format(region))
 
@@ -189,10 +279,9 @@ def get_regions(session, args):
         return([args.region])
 
     # otherwise return all the regions, us-east-1 first
-    ec2 = session.client('ec2')
-    response = ec2.describe_regions()
+    regions = describe_regions(session, args)
     output = ['us-east-1']
-    for r in response['Regions']:
+    for r in regions:
         # return us-east-1 first, but dont return it twice
         if r['RegionName'] == "us-east-1":
             continue
@@ -200,11 +289,11 @@ def get_regions(session, args):
 
     if args.exclude_regions:
         exclude_regions = ' '.join(args.exclude_regions).replace(',',' ').split()
-        output = list(set(output) - set(exclude_regions))
+        output = [r for r in output if r not in exclude_regions]
 
     return(output)
 
-def do_args():
+def do_args(argv=None, known_only=False):
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", help="print debugging info", action='store_true')
@@ -216,8 +305,18 @@ def do_args():
     parser.add_argument("--exclude-regions", nargs='+', help="REGION1, REGION2 Do not attempt to delete default VPCs in these regions")
     parser.add_argument("--vpc-id", help="Only delete the VPC specified")
     parser.add_argument("--actually-do-it", help="Actually Perform the action (default behavior is to report on what would be done)", action='store_true')
-
-    args = parser.parse_args()
+    parser.add_argument("--max-workers", help="Number of regions to process in parallel. Default is 10", type=int, default=10)
+    parser.add_argument("--teardown-workers", help="Number of resources to delete at once within each VPC. Default is 8", type=int, default=8)
+    parser.add_argument("--cache", help="Cache inventory (regions, buckets, users, keys) on disk between runs", action='store_true')
+    parser.add_argument("--refresh-cache", help="Ignore and replace any cached inventory", action='store_true')
+    parser.add_argument("--no-cache", help="Do not use the inventory cache, even if AWS_FAST_FIXES_CACHE is set", action='store_true')
+
+    if known_only:
+        # We are running alongside other fixes (see aws-fast-fixes.py), so leave their options to them,
+        # handing back whatever we didn't recognize as well
+        return(parser.parse_known_args(argv))
+    else:
+        args = parser.parse_args(argv)
 
     return(args)
 
@@ -253,5 +352,6 @@ if __name__ == '__main__':
 
     try:
         main(args, logger)
+        log_stats(logger)
     except KeyboardInterrupt:
         exit(1)
\ No newline at end of file
@@ -3,33 +3,43 @@
 import boto3
 from botocore.exceptions import ClientError
 import os
+import sys
 import logging
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fastfix.clients import log_stats
+from fastfix.regions import run_regions, region_client, describe_regions
 # logger = logging.getLogger()
 
 
-def main(args, logger):
+def main(args, logger, session=None):
     '''Executes the Primary Logic of the Fast Fix'''
 
     # If they specify a profile use it. Otherwise do the normal thing
-    if args.profile:
+    # (unless run-org-wide.py handed us a session for the account it is running the fix in)
+    if session is None and args.profile:
         session = boto3.Session(profile_name=args.profile)
-    else:
+    elif session is None:
         session = boto3.Session()
 
-    # Get all the Regions for this account
-    for region in get_regions(session, args):
-        ec2_client = session.client("ec2", region_name=region)
-
-        status_response = ec2_client.get_ebs_encryption_by_default()
-        if status_response['EbsEncryptionByDefault'] is not True:
-            # Make it true
-            if args.actually_do_it is True:
-                logger.info(f"Enabling Default EBS Encryption in {region}")
-                enable_default_encryption(ec2_client, region)
-            else:
-                logger.info(f"You Need To Enable Default EBS Encryption in {region}")
+    # Get all the Regions for this account and process them in parallel
+    all_regions = get_regions(session, args)
+    run_regions(lambda region: process_region(args, region, session, logger), all_regions, logger, args.max_workers)
+
+
+def process_region(args, region, session, logger):
+    '''Check and fix Default EBS Encryption in the region'''
+    ec2_client = region_client(session, "ec2", region)
+
+    status_response = ec2_client.get_ebs_encryption_by_default()
+    if status_response['EbsEncryptionByDefault'] is not True:
+        # Make it true
+        if args.actually_do_it is True:
+            logger.info(f"Enabling Default EBS Encryption in {region}")
+            enable_default_encryption(ec2_client, region)
         else:
-            logger.debug(f"Default EBS Encryption is enabled in {region}")
+            logger.info(f"You Need To Enable Default EBS Encryption in {region}")
+    else:
+        logger.debug(f"Default EBS Encryption is enabled in {region}")
 
 
 
@@ -52,10 +62,9 @@ def get_regions(session, args):
         return([args.region])
 
     # otherwise return all the regions, us-east-1 first
-    ec2 = session.client('ec2')
-    response = ec2.describe_regions()
+    regions = describe_regions(session, args)
     output = ['us-east-1']
-    for r in response['Regions']:
+    for r in regions:
         # return us-east-1 first, but dont return it twice
         if r['RegionName'] == "us-east-1":
             continue
@@ -64,7 +73,7 @@ def get_regions(session, args):
 
 
 
-def do_args():
+def do_args(argv=None, known_only=False):
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", help="print debugging info", action='store_true')
@@ -73,8 +82,17 @@ def do_args():
     parser.add_argument("--region", help="Only Process Specified Region")
     parser.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials)")
     parser.add_argument("--actually-do-it", help="Actually Perform the action", action='store_true')
-
-    args = parser.parse_args()
+    parser.add_argument("--max-workers", help="Number of regions to process in parallel. Default is 10", type=int, default=10)
+    parser.add_argument("--cache", help="Cache inventory (regions, buckets, users, keys) on disk between runs", action='store_true')
+    parser.add_argument("--refresh-cache", help="Ignore and replace any cached inventory", action='store_true')
+    parser.add_argument("--no-cache", help="Do not use the inventory cache, even if AWS_FAST_FIXES_CACHE is set", action='store_true')
+
+    if known_only:
+        # We are running alongside other fixes (see aws-fast-fixes.py), so leave their options to them,
+        # handing back whatever we didn't recognize as well
+        return(parser.parse_known_args(argv))
+    else:
+        args = parser.parse_args(argv)
 
     return(args)
 
@@ -110,5 +128,6 @@ if __name__ == '__main__':
 
     try:
         main(args, logger)
+        log_stats(logger)
     except KeyboardInterrupt:
         exit(1)
\ No newline at end of file
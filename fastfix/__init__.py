@@ -0,0 +1 @@
+'''Helpers shared by the aws-fast-fixes scripts'''
@@ -0,0 +1,136 @@
+'''Opt-in on-disk cache for slow moving inventory (regions, buckets, users, keys)
+
+Entries are kept in a SQLite database under ~/.cache/aws-fast-fixes, keyed by account, region and API call.
+The cache is only used if --cache is given on the command line or AWS_FAST_FIXES_CACHE is set in the environment.
+'''
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from types import GeneratorType
+from fastfix.clients import make_client
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'aws-fast-fixes')
+CACHE_FILE = 'inventory.sqlite'
+
+# Keep the database under this many bytes of cached values. The oldest entries are evicted first.
+MAX_CACHE_BYTES = 50 * 1024 * 1024
+
+# How long, in seconds, each kind of inventory is trusted for
+DEFAULT_TTL = 3600
+TTLS = {
+    'describe_regions': 7 * 24 * 3600,
+    'list_buckets': 3600,
+    'list_users': 3600,
+    'list_keys': 3600,
+}
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(session, args):
+    '''Return the inventory cache to use for session, based on the --cache, --no-cache & --refresh-cache args'''
+    enabled = getattr(args, 'cache', False) or getattr(args, 'refresh_cache', False) or bool(os.getenv('AWS_FAST_FIXES_CACHE'))
+    if getattr(args, 'no_cache', False) or not enabled:
+        return(NoCache())
+
+    with _caches_lock:
+        if id(session) not in _caches:
+            _caches[id(session)] = InventoryCache(session, refresh=getattr(args, 'refresh_cache', False))
+        return(_caches[id(session)])
+
+
+def forget_cache(session):
+    '''Drop the cache kept for session, once nothing will use session again'''
+    with _caches_lock:
+        _caches.pop(id(session), None)
+
+
+class NoCache(object):
+    '''Stand in for InventoryCache when caching is turned off. Always calls the loader'''
+
+    def get(self, region, call, loader, ttl=None):
+        return(loader())
+
+
+class InventoryCache(object):
+    '''Cache of API results for one account, stored in SQLite'''
+
+    def __init__(self, session, path=None, refresh=False, max_bytes=MAX_CACHE_BYTES):
+        self.session = session
+        self.path = path or os.path.join(CACHE_DIR, CACHE_FILE)
+        self.refresh = refresh
+        self.max_bytes = max_bytes
+        self._account = None
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._connect() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS inventory (
+                account TEXT, region TEXT, call TEXT, fetched_at REAL, value TEXT,
+                PRIMARY KEY (account, region, call))''')
+
+    @contextmanager
+    def _connect(self):
+        # A connection per call keeps this safe to use from the region worker threads
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield(db)
+        finally:
+            db.close()
+
+    @property
+    def account(self):
+        with self._lock:
+            if self._account is None:
+                self._account = make_client(self.session, 'sts').get_caller_identity()['Account']
+            return(self._account)
+
+    def get(self, region, call, loader, ttl=None):
+        '''Return the cached result of call in region, or call loader() and cache what it returns'''
+        if ttl is None:
+            ttl = TTLS.get(call.split(':')[0], DEFAULT_TTL)
+        key = (self.account, region, call)
+
+        if not self.refresh:
+            with self._connect() as db:
+                row = db.execute('SELECT fetched_at, value FROM inventory WHERE account=? AND region=? AND call=?', key).fetchone()
+            if row is not None and row[0] + ttl > time.time():
+                return(json.loads(row[1], object_hook=_decode))
+
+        value = loader()
+        if isinstance(value, GeneratorType):
+            value = list(value)  # Streaming results have to be gathered up before they can be cached
+        self.put(key, value)
+        return(value)
+
+    def put(self, key, value):
+        '''Store value under key, then evict the oldest entries if we are over max_bytes'''
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO inventory VALUES (?, ?, ?, ?, ?)', key + (time.time(), json.dumps(value, default=_encode)))
+            rows = db.execute('SELECT rowid, LENGTH(value) FROM inventory ORDER BY fetched_at DESC').fetchall()
+            total = 0
+            evict = []
+            for rowid, size in rows:
+                total += size
+                if total > self.max_bytes:
+                    evict.append((rowid,))
+            db.executemany('DELETE FROM inventory WHERE rowid=?', evict)
+
+
+def _encode(o):
+    '''json default= hook so the datetimes boto3 returns survive the round trip'''
+    if isinstance(o, datetime):
+        return({'__datetime__': o.isoformat()})
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+def _decode(d):
+    if '__datetime__' in d:
+        return(datetime.fromisoformat(d['__datetime__']))
+    return(d)
@@ -0,0 +1,115 @@
+'''Make boto3 clients with adaptive retries, optional client side rate limits, and counts of retries and throttling
+
+Every client the fast fixes use should come from here (usually by way of region_client() in fastfix.regions).
+
+Rate limits are calls per second, keyed by service (eg "iam") or by service and API (eg "kms:GetKeyRotationStatus"),
+the most specific winning. Each region gets its own bucket. Set them in RATE_LIMITS, or in the environment as
+AWS_FAST_FIXES_RATE_LIMITS="iam=10,kms:GetKeyRotationStatus=20".
+'''
+
+import os
+import threading
+from collections import Counter
+from botocore.config import Config
+from fastfix.ratelimit import TokenBucket
+from fastfix.throttle import THROTTLE_ERRORS
+
+# Adaptive mode retries throttled and transient errors with backoff, and slows a client down while it is being throttled
+RETRY_CONFIG = Config(retries={'mode': 'adaptive', 'max_attempts': 10}, max_pool_connections=50)
+
+RATE_LIMITS = {}
+
+# Counts of calls, retries and throttled responses by (what, service, API)
+stats = Counter()
+
+_create_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_buckets = {}
+_limits = None
+
+
+def make_client(session, service, region=None, config=None):
+    '''Return a new client for service in region. config (eg max_pool_connections) is merged over RETRY_CONFIG'''
+    # boto3 Sessions are not thread safe, so creation is serialized
+    with _create_lock:
+        client = session.client(service, region_name=region, config=RETRY_CONFIG.merge(config) if config else RETRY_CONFIG)
+    _instrument(client)
+    return(client)
+
+
+def make_resource(session, service, region=None):
+    '''Return a new boto3 resource for service in region, with the same retries, rate limits and counts as make_client()'''
+    with _create_lock:
+        resource = session.resource(service, region_name=region, config=RETRY_CONFIG)
+    _instrument(resource.meta.client)
+    return(resource)
+
+
+def get_rate_limits():
+    '''Return RATE_LIMITS with any limits from AWS_FAST_FIXES_RATE_LIMITS added'''
+    global _limits
+    if _limits is None:
+        limits = dict(RATE_LIMITS)
+        for item in os.getenv('AWS_FAST_FIXES_RATE_LIMITS', '').split(','):
+            if not item.strip():
+                continue
+            try:
+                key, rate = item.split('=')
+                limits[key.strip()] = float(rate)
+            except ValueError:
+                raise ValueError(f"Bad rate limit {item!r} in AWS_FAST_FIXES_RATE_LIMITS, expected service=rate or service:API=rate")
+        _limits = limits
+    return(_limits)
+
+
+def log_stats(logger):
+    '''Log how many calls were made, retried and throttled. Only worth an info line if anything was retried'''
+    with _stats_lock:
+        snapshot = Counter(stats)
+    total = dict((what, sum(n for (w, service, api), n in snapshot.items() if w == what)) for what in ['calls', 'retries', 'throttled'])
+    throttled = sorted(((n, f"{service} {api}") for (w, service, api), n in snapshot.items() if w == 'throttled'), reverse=True)
+    message = f"AWS API calls: {total['calls']}, retries: {total['retries']}, throttled: {total['throttled']}"
+    if throttled:
+        message += " (" + ", ".join(f"{api}: {n}" for n, api in throttled[:5]) + ")"
+    if total['retries'] or total['throttled']:
+        logger.info(message)
+    else:
+        logger.debug(message)
+
+
+def _instrument(client):
+    region = client.meta.region_name
+    client.meta.events.register('before-call', lambda model, **kwargs: _before_call(region, model))
+    client.meta.events.register('needs-retry', _needs_retry)
+    client.meta.events.register('after-call', _after_call)
+
+
+def _count(what, service, api, n=1):
+    with _stats_lock:
+        stats[(what, service, api)] += n
+
+
+def _before_call(region, model):
+    service, api = model.service_model.service_name, model.name
+    _count('calls', service, api)
+    limits = get_rate_limits()
+    key = f"{service}:{api}" if f"{service}:{api}" in limits else service
+    if key not in limits:
+        return
+    with _stats_lock:
+        if (region, key) not in _buckets:
+            _buckets[(region, key)] = TokenBucket(limits[key])
+        bucket = _buckets[(region, key)]
+    bucket.acquire()
+
+
+def _needs_retry(response, operation, **kwargs):
+    # Only counting here. Returning None leaves the retry decision to botocore
+    if response is not None and response[1].get('Error', {}).get('Code') in THROTTLE_ERRORS:
+        _count('throttled', operation.service_model.service_name, operation.name)
+
+
+def _after_call(parsed, model, **kwargs):
+    retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    if retries:
+        _count('retries', model.service_model.service_name, model.name, retries)
@@ -0,0 +1,31 @@
+'''Read the IAM credential report, which has the password and access key activity of every user in one call'''
+
+import csv
+import io
+import time
+from datetime import datetime
+
+# Values the report uses when a date doesn't apply or isn't known
+NO_DATE = ['N/A', 'no_information', 'not_supported', '']
+
+
+def get_credential_report(iam_client, wait=2, max_wait=300):
+    '''Yield each row of the credential report as a dict, generating the report first if needed.
+    IAM reuses a report for up to four hours, so this is normally a single call.'''
+    waited = 0
+    while iam_client.generate_credential_report()['State'] != 'COMPLETE':
+        if waited >= max_wait:
+            raise TimeoutError(f"Credential report was not ready after {max_wait} seconds")
+        time.sleep(wait)
+        waited += wait
+
+    response = iam_client.get_credential_report()
+    for row in csv.DictReader(io.TextIOWrapper(io.BytesIO(response['Content']), encoding='utf-8')):
+        yield(row)
+
+
+def report_date(value):
+    '''Return the report value as a datetime, or None if the report has no date for it'''
+    if value in NO_DATE:
+        return(None)
+    return(datetime.fromisoformat(value))
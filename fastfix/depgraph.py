@@ -0,0 +1,54 @@
+'''Run a set of dependent tasks (like tearing down a VPC) on a thread pool, each as soon as what it depends on is done'''
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from fastfix.throttle import with_backoff
+
+
+def run_graph(tasks, deps, max_workers=8, retry_codes=('DependencyViolation',), max_attempts=8):
+    '''Run tasks, a dict of name to callable. deps maps a name to the names that must finish before it starts.
+    Tasks failing with a ClientError code in retry_codes are retried with backoff, since AWS often
+    takes a moment to let go of something we just deleted.
+
+    Returns (failed, skipped): a dict of name to the exception for the tasks that failed, and the set of names
+    that never ran because something they depend on failed.'''
+    waiting = dict((name, set(d for d in deps.get(name, ()) if d in tasks)) for name in tasks)
+    dependents = defaultdict(set)
+    for name, waits in waiting.items():
+        for d in waits:
+            dependents[d].add(name)
+
+    failed = {}
+    skipped = set()
+
+    def skip_dependents(name):
+        for dependent in dependents[name]:
+            if dependent in waiting:
+                del waiting[dependent]
+                skipped.add(dependent)
+                skip_dependents(dependent)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while True:
+            for name in [name for name, waits in waiting.items() if not waits]:
+                del waiting[name]
+                running[executor.submit(with_backoff, tasks[name], retry_codes=retry_codes, max_attempts=max_attempts)] = name
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    failed[name] = e
+                    skip_dependents(name)
+                    continue
+                for dependent in dependents[name]:
+                    if dependent in waiting:
+                        waiting[dependent].discard(name)
+
+    # Anything still waiting is part of a cycle and could never start
+    skipped.update(waiting)
+    return(failed, skipped)
@@ -0,0 +1,48 @@
+'''The fast fixes that can be run as modules (for many accounts at once, or several in one process), and how to load them'''
+
+import importlib.util
+import itertools
+import os
+import sys
+import threading
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Short name -> the script, for the fixes that run within a single account.
+# The org-delegation scripts are left out as they only make sense in the organization's payer account.
+FIXES = {
+    'ebs': 'ebs-encryption/enable-ebs-default-encryption.py',
+    'kms': 'kms-key-rotation/enable-kms-key-rotation.py',
+    'guardduty': 'guardduty/enable-guardduty.py',
+    'flowlogs': 'vpc-flow-logs/enable-vpc-flowlogs.py',
+    'default-vpcs': 'delete-default-vpc/delete-default-vpcs.py',
+    's3-public-access': 's3-block-public-access/enable-s3-block-public-access.py',
+    's3-encryption': 's3-bucket-default-encryption/enable-s3-bucket-default-encryption.py',
+    'inactive-keys': 'inactive-iam-users/disable-inactive-keys.py',
+    'inactive-login': 'inactive-iam-users/disable-inactive-login.py',
+    'ssm-role': 'ssm-role/ssm-role.py',
+}
+
+_loaded = itertools.count()
+_code = {}
+_load_lock = threading.Lock()
+
+
+def load_fix(name):
+    '''Load a fresh copy of the named fix script as a module.
+    Each copy has its own globals (args, logger and any per-run caches), so copies can run side by side.
+    The script is only read and compiled the first time, and sys.path is left as it was (each script adds the repo
+    to it), so loading a copy per account doesn't grow sys.path.'''
+    path = os.path.join(REPO_DIR, FIXES[name])
+    with _load_lock:
+        if name not in _code:
+            with open(path) as f:
+                _code[name] = compile(f.read(), path, 'exec')
+        spec = importlib.util.spec_from_file_location(f"fastfix_{name.replace('-', '_')}_{next(_loaded)}", path)
+        module = importlib.util.module_from_spec(spec)
+        saved_path = list(sys.path)
+        try:
+            exec(_code[name], module.__dict__)
+        finally:
+            sys.path[:] = saved_path
+    return(module)
@@ -0,0 +1,25 @@
+'''Stream IAM users for the inactive user fixes'''
+
+
+def get_all_users(iam_client, path_prefix=None):
+    '''Yield every IAM User (optionally only those under path_prefix) a page at a time.
+    Only the UserName, PasswordLastUsed and CreateDate of each user are kept.'''
+    params = {}
+    if path_prefix:
+        params['PathPrefix'] = path_prefix
+
+    paginator = iam_client.get_paginator('list_users')
+    for page in paginator.paginate(**params):  # Gotta Catch 'em all!
+        for u in page['Users']:
+            user = {'UserName': u['UserName'], 'CreateDate': u['CreateDate']}
+            if 'PasswordLastUsed' in u:
+                user['PasswordLastUsed'] = u['PasswordLastUsed']
+            yield(user)
+
+
+def in_path(arn, path_prefix):
+    '''Return True if the user with this arn is under path_prefix (or no path_prefix was given)'''
+    if not path_prefix:
+        return(True)
+    # arn:aws:iam::123456789012:user/division/team/username
+    return(arn.split(':user', 1)[-1].startswith(path_prefix))
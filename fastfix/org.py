@@ -0,0 +1,73 @@
+'''Run a fast fix in every account of an AWS Organization, by assuming a role in each'''
+
+import threading
+import boto3
+from botocore.credentials import RefreshableCredentials
+from botocore.session import get_session
+from fastfix.clients import make_client
+from fastfix.pool import run_logged
+
+
+def get_accounts(session):
+    '''Return the active accounts in the organization as dicts with Id and Name. Needs organizations:ListAccounts'''
+    paginator = make_client(session, 'organizations').get_paginator('list_accounts')
+    return([{'Id': a['Id'], 'Name': a['Name']} for a in paginator.paginate().search('Accounts[]') if a['Status'] == 'ACTIVE'])
+
+
+class AccountSessions(object):
+    '''Hands out a boto3 Session for each account, assuming role_name in it. A session is made once per account and
+    its credentials refresh themselves before they expire, so long runs don't fail part way through an account.
+    The account we are running in gets our own session, as the role usually doesn't exist there.'''
+
+    def __init__(self, session, role_name, session_name='aws-fast-fixes'):
+        self.session = session
+        self.role_name = role_name
+        self.session_name = session_name
+        self.sts = make_client(session, 'sts')
+        identity = self.sts.get_caller_identity()
+        self.home_account = identity['Account']
+        self.partition = identity['Arn'].split(':')[1]
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, account_id):
+        '''Return the session for account_id'''
+        with self.lock:
+            if account_id in self.sessions:
+                return(self.sessions[account_id])
+        # Assuming the role is slow, so do it outside the lock. Each account is only asked for by its own worker.
+        session = self.session if account_id == self.home_account else self._assume(account_id)
+        with self.lock:
+            return(self.sessions.setdefault(account_id, session))
+
+    def forget(self, account_id):
+        '''Stop holding on to account_id's session. Returns it, or None if there wasn't one'''
+        with self.lock:
+            return(self.sessions.pop(account_id, None))
+
+    def _assume(self, account_id):
+        role_arn = f"arn:{self.partition}:iam::{account_id}:role/{self.role_name}"
+
+        def refresh():
+            credentials = self.sts.assume_role(RoleArn=role_arn, RoleSessionName=self.session_name)['Credentials']
+            return({
+                'access_key': credentials['AccessKeyId'],
+                'secret_key': credentials['SecretAccessKey'],
+                'token': credentials['SessionToken'],
+                'expiry_time': credentials['Expiration'].isoformat(),
+            })
+
+        botocore_session = get_session()
+        # botocore has no public way to hand a session refreshable credentials
+        botocore_session._credentials = RefreshableCredentials.create_from_metadata(
+            metadata=refresh(), refresh_using=refresh, method='sts-assume-role')
+        return(boto3.Session(botocore_session=botocore_session, region_name=self.session.region_name))
+
+
+def run_accounts(func, accounts, logger, max_workers=8):
+    '''Call func(account, account_logger) for every account using up to max_workers threads, see run_logged().
+    Log lines are written account by account, and a failing account doesn't stop the others.
+    Returns a list of (account, result, exception, seconds) in the order of accounts.'''
+    by_id = dict((account['Id'], account) for account in accounts)
+    results = run_logged(lambda account_id, account_logger: func(by_id[account_id], account_logger), list(by_id), logger, max_workers)
+    return([(by_id[account_id], result, error, seconds) for account_id, result, error, seconds in results])
@@ -0,0 +1,112 @@
+'''Small thread pool helpers used by the fast fixes'''
+
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def ordered_map(func, items, max_workers):
+    '''Yield func(item) for each item in the order given, running up to max_workers at once.
+    items can be any iterable (including a generator), and only a few batches are read ahead of the results,
+    so memory stays flat. An exception from func is raised when its result is reached.'''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_workers * 4:
+                yield(pending.popleft().result())
+        while pending:
+            yield(pending.popleft().result())
+
+
+class BackgroundWriter(object):
+    '''Run func(*args) for each submitted change, one at a time, on a thread of its own.
+    Use this to keep the writes of a fast fix apart from (and from slowing down) the reads.'''
+
+    def __init__(self, func, limiter=None):
+        self.func = func
+        self.limiter = limiter
+        self.count = 0
+        self.errors = []
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, *args):
+        self.queue.put(args)
+
+    def close(self):
+        '''Wait for all the submitted changes to be made. Raises the first exception any of them raised'''
+        self.queue.put(None)
+        self.thread.join()
+        if self.errors:
+            raise self.errors[0]
+        return(self.count)
+
+    def _run(self):
+        while True:
+            args = self.queue.get()
+            if args is None:
+                return
+            if self.errors:
+                continue  # Something already failed, don't make any more changes
+            try:
+                if self.limiter is not None:
+                    self.limiter.acquire()
+                self.func(*args)
+                self.count += 1
+            except Exception as e:
+                self.errors.append(e)
+
+
+class _HeldRecords(logging.Handler):
+    '''Keeps the records logged for one job until they can be written out in order'''
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def _run_logged(func, name, job_logger):
+    start = time.time()
+    try:
+        return(func(name, job_logger), None, time.time() - start)
+    except Exception as e:
+        job_logger.error(f"Failed in {name}: {e!r}")
+        return(None, e, time.time() - start)
+
+
+def run_logged(func, names, logger, max_workers):
+    '''Call func(name, job_logger) for every name using up to max_workers threads.
+
+    Each job gets a child of logger (named logger.name) of its own, so jobs that call run_regions() themselves don't
+    get in each other's way. Log lines are written job by job, in the order of names. Unlike run_regions(), a failing
+    job doesn't stop the others. Returns a list of (name, result, exception, seconds) in the order of names.
+    '''
+    names = list(names)
+    held = {}
+    for name in names:
+        job_logger = logging.getLogger(f"{logger.name}.{name}")
+        job_logger.setLevel(logger.getEffectiveLevel())
+        job_logger.propagate = False
+        held[name] = _HeldRecords()
+        job_logger.handlers = [held[name]]
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(names) or 1))) as executor:
+        futures = [(name, executor.submit(_run_logged, func, name, logging.getLogger(f"{logger.name}.{name}"))) for name in names]
+        for name, future in futures:
+            result, error, seconds = future.result()
+            for record in held[name].records:
+                for handler in logger.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            held[name].records = []
+            results.append((name, result, error, seconds))
+    return(results)
@@ -0,0 +1,28 @@
+'''Client side rate limiting, so concurrent workers stay under an AWS API's request rate quota'''
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    '''Allow rate calls per second on average, with bursts of up to burst calls. Safe to share between threads.'''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Block until a call is allowed'''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
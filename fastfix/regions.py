@@ -0,0 +1,151 @@
+'''Run the per-region work of a fast fix on a bounded thread pool'''
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fastfix.cache import get_cache, forget_cache
+from fastfix.clients import make_client, make_resource
+from fastfix.s3posture import forget_shared_pool
+
+_local = threading.local()
+_clients_lock = threading.Lock()
+_clients = {}
+_regions = {}
+_regions_lock = threading.Lock()
+
+
+def region_client(session, service, region):
+    '''Return a client for service in region. Clients are thread safe, so one is shared by every thread (and every fix)
+    using session, along with its pool of kept-alive connections'''
+    key = (id(session), 'client', service, region)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = make_client(session, service, region)
+        return(_clients[key])
+
+
+def region_resource(session, service, region):
+    '''Return a boto3 resource for service in region. Resources aren't thread safe, so each worker thread gets its own'''
+    cache = getattr(_local, 'resources', None)
+    if cache is None:
+        cache = _local.resources = {}
+    key = (id(session), 'resource', service, region)
+    if key not in cache:
+        cache[key] = make_resource(session, service, region)
+    return(cache[key])
+
+
+def describe_regions(session, args):
+    '''Return the Regions from ec2:DescribeRegions (through the inventory cache). Only the first call for a session
+    asks, so fixes sharing a session in one process (see aws-fast-fixes.py) only discover the regions once'''
+    with _regions_lock:
+        if id(session) not in _regions:
+            ec2 = region_client(session, 'ec2', None)
+            _regions[id(session)] = get_cache(session, args).get('global', 'describe_regions', lambda: ec2.describe_regions()['Regions'])
+        return(_regions[id(session)])
+
+
+def forget_session(session):
+    '''Drop the clients, region list, inventory cache and shared S3 pool kept for session, so they can be freed once
+    nothing will use session again (eg when run-org-wide.py has finished an account). Resources made by worker threads
+    go with the threads'''
+    with _clients_lock:
+        for key in [key for key in _clients if key[0] == id(session)]:
+            del _clients[key]
+    with _regions_lock:
+        _regions.pop(id(session), None)
+    cache = getattr(_local, 'resources', None)
+    if cache is not None:
+        for key in [key for key in cache if key[0] == id(session)]:
+            del cache[key]
+    forget_cache(session)
+    forget_shared_pool(session)
+
+
+class _OrderedRegionHandler(logging.Handler):
+    '''Holds back records logged from a region worker so they can be written out in region order'''
+
+    def __init__(self, handlers):
+        super().__init__()
+        self.handlers = handlers
+
+    def emit(self, record):
+        buffer = getattr(_local, 'log_buffer', None)
+        if buffer is not None:
+            buffer.append(record)
+        else:
+            self.dispatch([record])
+
+    def dispatch(self, records):
+        for record in records:
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+def in_region(func):
+    '''Return func wrapped so that when it runs on another thread (eg as a run_graph() task in a region worker), what it
+    logs is held with the rest of the current region's output and written out in region order by run_regions()'''
+    buffer = getattr(_local, 'log_buffer', None)
+    if buffer is None:
+        return(func)
+
+    def wrapper(*args, **kwargs):
+        saved = getattr(_local, 'log_buffer', None)
+        _local.log_buffer = buffer
+        try:
+            return(func(*args, **kwargs))
+        finally:
+            _local.log_buffer = saved
+    return(wrapper)
+
+
+def _run_buffered(func, region):
+    '''Run func(region) in a worker, returning the records it logged along with the result or exception'''
+    _local.log_buffer = []
+    try:
+        return(_local.log_buffer, func(region), None)
+    except Exception as e:
+        return(_local.log_buffer, None, e)
+    finally:
+        _local.log_buffer = None
+
+
+def run_regions(func, regions, logger, max_workers=10):
+    '''Call func(region) for every region using up to max_workers threads.
+
+    Log lines from each region are written in the order of regions, and a list of (region, result) is returned in
+    that same order. If a region raises, the regions not yet started are cancelled, the ones already running are
+    waited for (and what they logged is written out, as they may have changed things) and the exception is re-raised.
+    '''
+    regions = list(regions)
+    handlers = logger.handlers
+    ordered_handler = _OrderedRegionHandler(handlers)
+    logger.handlers = [ordered_handler]
+
+    results = []
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(regions) or 1)))
+    futures = [(region, executor.submit(_run_buffered, func, region)) for region in regions]
+    try:
+        for i, (region, future) in enumerate(futures):
+            records, result, error = future.result()
+            ordered_handler.dispatch(records)
+            if error is not None:
+                _finish_started(futures[i + 1:], ordered_handler)
+                raise error
+            results.append((region, result))
+    finally:
+        executor.shutdown(wait=True)
+        logger.handlers = handlers
+    return(results)
+
+
+def _finish_started(futures, ordered_handler):
+    '''Cancel the regions that haven't started, then wait for the rest and write out their records in region order'''
+    for region, future in futures:
+        future.cancel()
+    for region, future in futures:
+        if future.cancelled():
+            continue
+        records, result, error = future.result()
+        ordered_handler.dispatch(records)
@@ -0,0 +1,172 @@
+'''Fetch the configuration of many S3 buckets once, in parallel, for the S3 fast fixes to evaluate'''
+
+import threading
+from concurrent.futures import Future
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from fastfix.clients import make_client
+from fastfix.pool import ordered_map
+
+# The bucket configuration we know how to collect, and the S3 API call that returns it
+POSTURE_CALLS = {
+    'public_access_block': 'get_public_access_block',
+    'acl': 'get_bucket_acl',
+    'policy': 'get_bucket_policy',
+    'website': 'get_bucket_website',
+    'encryption': 'get_bucket_encryption',
+}
+
+_shared_pools = {}
+_shared_lock = threading.Lock()
+
+
+def share_postures(session, max_connections=10):
+    '''Have every S3 fix using session share one S3ClientPool (see get_pool()), so when they run together
+    (see aws-fast-fixes.py) the buckets are listed once and each bucket's posture calls are made once between them'''
+    with _shared_lock:
+        if id(session) not in _shared_pools:
+            _shared_pools[id(session)] = S3ClientPool(session, max_connections, share=True)
+
+
+def forget_shared_pool(session):
+    '''Drop the shared pool kept for session, once nothing will use session again'''
+    with _shared_lock:
+        _shared_pools.pop(id(session), None)
+
+
+def get_pool(session, max_connections=10):
+    '''Return the S3ClientPool for a fix to use: the shared one if share_postures() was called for session,
+    otherwise a new one of its own'''
+    with _shared_lock:
+        if id(session) in _shared_pools:
+            return(_shared_pools[id(session)])
+    return(S3ClientPool(session, max_connections))
+
+
+class S3ClientPool(object):
+    '''Hands out S3 clients pinned to the region each bucket lives in, so per-bucket calls aren't redirected.
+    Bucket regions are looked up once, and there is one client (and so one pool of kept-alive connections) per region.
+    A pool made with share=True also remembers the bucket list and every posture call's result, for the fixes sharing
+    it. Otherwise nothing is kept, so memory stays flat however many buckets there are.'''
+
+    def __init__(self, session, max_connections=10, share=False):
+        self.session = session
+        self.config = Config(max_pool_connections=max_connections)
+        self.clients = {}
+        self.bucket_regions = {}
+        self.share = share
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def once(self, key, loader):
+        '''Return loader(), only calling it the first time key is asked for if this pool is shared.
+        When two fixes ask at the same time the second waits for the first's answer rather than asking again.'''
+        if not self.share:
+            return(loader())
+        with self.lock:
+            future = self.results.get(key)
+            first = future is None
+            if first:
+                future = self.results[key] = Future()
+        if first:
+            try:
+                value = loader()
+                if not isinstance(value, (list, dict)):
+                    value = list(value)  # Streaming results have to be gathered up to be handed out twice
+                future.set_result(value)
+            except Exception as e:
+                future.set_exception(e)
+        return(future.result())
+
+    def client(self, region):
+        '''Return the S3 client for region, or for the session's default region if region is None'''
+        with self.lock:
+            if region not in self.clients:
+                self.clients[region] = make_client(self.session, 's3', region, config=self.config)
+            return(self.clients[region])
+
+    def client_for(self, bucket):
+        '''Return the S3 client for the region bucket lives in'''
+        return(self.client(self.bucket_region(bucket)))
+
+    def set_bucket_region(self, bucket, region):
+        '''Record bucket's region when we already know it, saving a lookup'''
+        self.bucket_regions[bucket] = region
+
+    def bucket_region(self, bucket):
+        '''Return the region bucket lives in (or None if we can't tell), looking it up the first time we are asked'''
+        if bucket not in self.bucket_regions:
+            self.bucket_regions[bucket] = self._lookup_region(bucket)
+        return(self.bucket_regions[bucket])
+
+    def _lookup_region(self, bucket):
+        try:
+            response = self.client('us-east-1').get_bucket_location(Bucket=bucket)
+            location = response.get('LocationConstraint')
+            # Buckets in us-east-1 have no LocationConstraint, and very old eu-west-1 buckets say EU
+            if not location:
+                return('us-east-1')
+            if location == 'EU':
+                return('eu-west-1')
+            return(location)
+        except ClientError as e:
+            # Even when we can't call GetBucketLocation, S3 tells us the region in a header
+            # If it doesn't, fall back to the session's default region and let botocore follow any redirect.
+            return(e.response.get('ResponseMetadata', {}).get('HTTPHeaders', {}).get('x-amz-bucket-region'))
+
+
+class BucketPosture(object):
+    '''The responses (or ClientErrors) of the posture calls for one bucket'''
+    __slots__ = ['name', 'responses', 'errors']
+
+    def __init__(self, name):
+        self.name = name
+        self.responses = {}
+        self.errors = {}
+
+    def result(self, call):
+        '''Return the response for call, or raise the ClientError it returned, just like calling the API would'''
+        if call in self.errors:
+            raise self.errors[call]
+        return(self.responses[call])
+
+
+def get_bucket_posture(s3_pool, bucket, calls, more_calls=(), needs_more=None):
+    '''Return a BucketPosture for bucket with the given posture calls made once each.
+    more_calls are only made as well if needs_more(posture) says the first calls show they are needed'''
+    posture = BucketPosture(bucket)
+    _make_calls(s3_pool, posture, calls)
+    if more_calls and needs_more(posture):
+        _make_calls(s3_pool, posture, more_calls)
+    return(posture)
+
+
+def _make_calls(s3_pool, posture, calls):
+    bucket = posture.name
+    for call in calls:
+        try:
+            posture.responses[call] = s3_pool.once((bucket, call), lambda: _posture_call(s3_pool, bucket, call))
+        except ClientError as e:
+            posture.errors[call] = e
+
+
+def _posture_call(s3_pool, bucket, call):
+    response = getattr(s3_pool.client_for(bucket), POSTURE_CALLS[call])(Bucket=bucket)
+    response.pop('ResponseMetadata', None)
+    return(response)
+
+
+def collect_bucket_postures(s3_pool, buckets, calls, max_workers=16, more_calls=(), needs_more=None):
+    '''Yield a BucketPosture for each bucket in the order given, working on up to max_workers buckets at once.
+    more_calls are made for the buckets needs_more(posture) picks out, see get_bucket_posture().
+    buckets can be any iterable of bucket names or ListBuckets style dicts (Name and BucketRegion). Only a few
+    batches of buckets are held in memory at a time, so a generator is consumed as the postures are used.'''
+    def bucket_name(bucket):
+        if isinstance(bucket, dict):
+            if bucket.get('BucketRegion'):
+                s3_pool.set_bucket_region(bucket['Name'], bucket['BucketRegion'])
+            return(bucket['Name'])
+        return(bucket)
+
+    names = (bucket_name(bucket) for bucket in buckets)
+    return(ordered_map(lambda bucket: get_bucket_posture(s3_pool, bucket, calls, more_calls, needs_more), names, max_workers))
@@ -0,0 +1,28 @@
+'''Recognize throttling, and back off and retry AWS calls failing with errors botocore doesn't retry itself'''
+
+import random
+import time
+from botocore.exceptions import ClientError
+
+# The error codes that mean a request was throttled
+THROTTLE_ERRORS = [
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'SlowDown',
+]
+
+
+def with_backoff(func, *args, max_attempts=8, base_delay=0.5, max_delay=20, retry_codes=(), **kwargs):
+    '''Call func(*args, **kwargs), retrying errors with a code in retry_codes (eg DependencyViolation) with exponential
+    backoff and full jitter. Throttling is not retried here, the clients already do that (see fastfix.clients).'''
+    for attempt in range(max_attempts):
+        try:
+            return(func(*args, **kwargs))
+        except ClientError as e:
+            retry = e.response['Error']['Code'] in retry_codes
+            if not retry or attempt == max_attempts - 1:
+                raise
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
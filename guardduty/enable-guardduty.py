@@ -3,50 +3,80 @@
 import boto3
 from botocore.exceptions import ClientError
 import os
+import sys
 import logging
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fastfix.clients import log_stats
+from fastfix.regions import run_regions, region_client, describe_regions
 # logger = logging.getLogger()
 
 
-def main(args, logger):
+def main(args, logger, session=None):
     '''Executes the Primary Logic of the Fast Fix'''
 
     # If they specify a profile use it. Otherwise do the normal thing
-    if args.profile:
+    # (unless run-org-wide.py handed us a session for the account it is running the fix in)
+    if session is None and args.profile:
         session = boto3.Session(profile_name=args.profile)
-    else:
+    elif session is None:
         session = boto3.Session()
 
-    # Get all the Regions for this account
-    for region in get_regions(session, args):
-        guardduty_client = session.client("guardduty", region_name=region)
-
-        status_response = guardduty_client.list_detectors()
-        if len(status_response['DetectorIds']) == 0:
-            # Make it true
-            if args.actually_do_it is True:
-                logger.info(f"Enabling GuardDuty in {region}")
-                detector_id = enable_guarduty(guardduty_client, region)
-            else:
-                logger.info(f"You Need To Enable GuardDuty in {region}")
-                continue
+    # Get all the Regions for this account and process them in parallel
+    all_regions = get_regions(session, args)
+    run_regions(lambda region: process_region(args, region, session, logger), all_regions, logger, args.max_workers)
+
+
+def process_region(args, region, session, logger):
+    '''Enable GuardDuty in the region and accept the invitation from the master if asked to'''
+    guardduty_client = region_client(session, "guardduty", region)
+
+    detector_ids = get_detector_ids(guardduty_client)
+    if len(detector_ids) == 0:
+        # Make it true
+        if args.actually_do_it is True:
+            logger.info(f"Enabling GuardDuty in {region}")
+            detector_id = enable_guarduty(guardduty_client, region)
         else:
-            detector_id = status_response['DetectorIds'][0]
-            logger.debug(f"GuardDuty is enabled in {region}")
+            logger.info(f"You Need To Enable GuardDuty in {region}")
+            return
+    else:
+        detector_id = detector_ids[0]
+        logger.debug(f"GuardDuty is enabled in {region}")
 
-        if args.MasterId is None:
-            continue  # Not doing invite acceptance
+    if args.MasterId is None:
+        return  # Not doing invite acceptance
 
-        # Now do the invitations
-        invite_response = guardduty_client.list_invitations() # probably need to support paganation
-        for i in invite_response['Invitations']:
-            if i['AccountId'] != args.MasterId:
-                logger.warning(f"Invite from {i['AccountId']} is not the expected master. Not gonna accept it, wouldn't be prudent.")
-                continue
-            elif args.actually_do_it is True:
-                logger.info(f"Accepting invitation {i['InvitationId']} from {args.MasterId} for {detector_id} in {region}")
-                accept_invitation(guardduty_client, region, detector_id, args.MasterId, i['InvitationId'])
-            else:
-                logger.info(f"Need to accept invitation {i['InvitationId']} from {args.MasterId} for {detector_id} in {region}")
+    # Now do the invitations, all pages of them
+    invitations = []
+    for i in get_invitations(guardduty_client):
+        if i['AccountId'] != args.MasterId:
+            logger.warning(f"Invite from {i['AccountId']} is not the expected master. Not gonna accept it, wouldn't be prudent.")
+            continue
+        invitations.append(i)
+    if not invitations:
+        return
+
+    # A detector can only have one master, so accepting the latest invitation from it covers them all
+    i = max(invitations, key=lambda i: i.get('InvitedAt', ''))
+    if args.actually_do_it is True:
+        logger.info(f"Accepting invitation {i['InvitationId']} from {args.MasterId} for {detector_id} in {region}")
+        accept_invitation(guardduty_client, region, detector_id, args.MasterId, i['InvitationId'])
+    else:
+        logger.info(f"Need to accept invitation {i['InvitationId']} from {args.MasterId} for {detector_id} in {region}")
+
+
+def get_detector_ids(guardduty_client):
+    '''Return the ids of all the detectors in the client's region'''
+    paginator = guardduty_client.get_paginator('list_detectors')
+    return(list(paginator.paginate().search('DetectorIds[]')))
+
+
+def get_invitations(guardduty_client):
+    '''Yield every invitation in the client's region, a page at a time'''
+    paginator = guardduty_client.get_paginator('list_invitations')
+    for page in paginator.paginate(PaginationConfig={'PageSize': 50}):
+        for invitation in page['Invitations']:
+            yield(invitation)
 
 
 def accept_invitation(guardduty_client, region, detector_id, master_id, invitation_id):
@@ -84,10 +114,9 @@ def get_regions(session, args):
         return([args.region])
 
     # otherwise return all the regions, us-east-1 first
-    ec2 = session.client('ec2')
-    response = ec2.describe_regions()
+    regions = describe_regions(session, args)
     output = ['us-east-1']
-    for r in response['Regions']:
+    for r in regions:
         # return us-east-1 first, but dont return it twice
         if r['RegionName'] == "us-east-1":
             continue
@@ -95,7 +124,7 @@ def get_regions(session, args):
     return(output)
 
 
-def do_args():
+def do_args(argv=None, known_only=False):
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", help="print debugging info", action='store_true')
@@ -104,9 +133,18 @@ def do_args():
     parser.add_argument("--region", help="Only Process Specified Region")
     parser.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials)")
     parser.add_argument("--actually-do-it", help="Actually Perform the action", action='store_true')
+    parser.add_argument("--max-workers", help="Number of regions to process in parallel. Default is 10", type=int, default=10)
     parser.add_argument("--accept-invite", dest='MasterId', help="Accept an invitation (if present) from this AccountId")
-
-    args = parser.parse_args()
+    parser.add_argument("--cache", help="Cache inventory (regions, buckets, users, keys) on disk between runs", action='store_true')
+    parser.add_argument("--refresh-cache", help="Ignore and replace any cached inventory", action='store_true')
+    parser.add_argument("--no-cache", help="Do not use the inventory cache, even if AWS_FAST_FIXES_CACHE is set", action='store_true')
+
+    if known_only:
+        # We are running alongside other fixes (see aws-fast-fixes.py), so leave their options to them,
+        # handing back whatever we didn't recognize as well
+        return(parser.parse_known_args(argv))
+    else:
+        args = parser.parse_args(argv)
 
     return(args)
 
@@ -142,5 +180,6 @@ if __name__ == '__main__':
 
     try:
         main(args, logger)
+        log_stats(logger)
     except KeyboardInterrupt:
         exit(1)
\ No newline at end of file
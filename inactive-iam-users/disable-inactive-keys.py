@@ -3,55 +3,96 @@
 import boto3
 from botocore.exceptions import ClientError
 import os
+import sys
 import logging
+import time
 from datetime import datetime, timedelta
 import pytz
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fastfix.cache import get_cache
+from fastfix.clients import log_stats
+from fastfix.credreport import get_credential_report, report_date
+from fastfix.iamusers import get_all_users, in_path
+from fastfix.pool import ordered_map, BackgroundWriter
+from fastfix.ratelimit import TokenBucket
+from fastfix.regions import region_client
 
 utc=pytz.UTC
 
-def main(args, logger):
+def main(args, logger, session=None):
     '''Executes the Primary Logic of the Fast Fix'''
 
     # If they specify a profile use it. Otherwise do the normal thing
-    if args.profile:
+    # (unless run-org-wide.py handed us a session for the account it is running the fix in)
+    if session is None and args.profile:
         session = boto3.Session(profile_name=args.profile)
-    else:
+    elif session is None:
         session = boto3.Session()
 
     # S3 is a global service and we can use any regional endpoint for this.
-    iam_client = session.client("iam")
-    for user in get_all_users(iam_client):
-        username = user['UserName']
-
-        keys = get_users_keys(iam_client, username)
-        if len(keys) == 0:
-            logger.debug(f"User {username} has no active keys")
-            continue
-
-        for key in keys:
-
-            # Get the last used date
-            activity_response = iam_client.get_access_key_last_used(AccessKeyId=key)
-            if 'AccessKeyLastUsed' not in activity_response :
-                logger.error(f"Did not get AccessKeyLastUsed for user {username} key {key}")
-                continue
-            if 'LastUsedDate' not in activity_response['AccessKeyLastUsed']:
-                logger.debug(f"Key {key} for {username} has never been used")
+    iam_client = region_client(session, "iam", None)
+    if args.credential_report:
+        # The credential report tells us who has an active key that looks inactive. Only they get checked key by key.
+        users = get_report_candidates(iam_client, args.threshold, args.path_prefix)
+    else:
+        users = get_cache(session, args).get('global', f"list_users:{args.path_prefix}", lambda: get_all_users(iam_client, args.path_prefix))
+
+    # IAM quotas are account wide, so all the readers share one rate limit and the disables get their own
+    read_limiter = TokenBucket(args.max_reads_per_second)
+    writer = None
+    if args.actually_do_it is True:
+        writer = BackgroundWriter(lambda key, username: disable_key(iam_client, key, username), TokenBucket(args.max_writes_per_second))
+
+    read_start = time.monotonic()
+    write_start = None
+    user_count = 0
+    key_count = 0
+    try:
+        for username, key_activity in ordered_map(lambda user: get_key_activity(iam_client, user['UserName'], read_limiter), users, args.max_workers):
+            user_count += 1
+            key_count += len(key_activity)
+            if len(key_activity) == 0:
+                logger.debug(f"User {username} has no active keys")
                 continue
 
-            # Otherwise decide what to do
-            last_used_date = activity_response['AccessKeyLastUsed']['LastUsedDate']
-            utc=pytz.UTC  # We need to normalize the date & timezones
-            if last_used_date > utc.localize(datetime.today() - timedelta(days=int(args.threshold))):
-                # Then we are good
-                logger.debug(f"Key {key} ({username}) - last used {last_used_date} is OK")
-            elif args.actually_do_it is True:
-                # otherwise if we're configured to fix
-                logger.info(f"Disabling Key {key} for {username} - Last used {activity_response['AccessKeyLastUsed']['LastUsedDate']} in {activity_response['AccessKeyLastUsed']['Region']} for {activity_response['AccessKeyLastUsed']['ServiceName']}")
-                disable_key(iam_client, key, username)
-            else:
-                # otherwise just report
-                logger.info(f"Need to Disable Key {key} for {username} - Last used {activity_response['AccessKeyLastUsed']['LastUsedDate']} in {activity_response['AccessKeyLastUsed']['Region']} for {activity_response['AccessKeyLastUsed']['ServiceName']}")
+            for key, activity_response in key_activity:
+
+                # Check the last used date
+                if 'AccessKeyLastUsed' not in activity_response :
+                    logger.error(f"Did not get AccessKeyLastUsed for user {username} key {key}")
+                    continue
+                if 'LastUsedDate' not in activity_response['AccessKeyLastUsed']:
+                    logger.debug(f"Key {key} for {username} has never been used")
+                    continue
+
+                # Otherwise decide what to do
+                last_used_date = activity_response['AccessKeyLastUsed']['LastUsedDate']
+                utc=pytz.UTC  # We need to normalize the date & timezones
+                if last_used_date > utc.localize(datetime.today() - timedelta(days=int(args.threshold))):
+                    # Then we are good
+                    logger.debug(f"Key {key} ({username}) - last used {last_used_date} is OK")
+                elif args.actually_do_it is True:
+                    # otherwise if we're configured to fix
+                    logger.info(f"Disabling Key {key} for {username} - Last used {activity_response['AccessKeyLastUsed']['LastUsedDate']} in {activity_response['AccessKeyLastUsed']['Region']} for {activity_response['AccessKeyLastUsed']['ServiceName']}")
+                    if write_start is None:
+                        write_start = time.monotonic()
+                    writer.submit(key, username)
+                else:
+                    # otherwise just report
+                    logger.info(f"Need to Disable Key {key} for {username} - Last used {activity_response['AccessKeyLastUsed']['LastUsedDate']} in {activity_response['AccessKeyLastUsed']['Region']} for {activity_response['AccessKeyLastUsed']['ServiceName']}")
+
+        read_seconds = time.monotonic() - read_start
+    finally:
+        # The disables already queued have been logged, so make them even if the reads failed part way through
+        if writer is not None:
+            disabled = writer.close()
+
+    logger.info(f"Checked {user_count} users and {key_count} keys in {read_seconds:.1f}s ({(user_count + key_count) / max(read_seconds, 0.001):.1f} calls/s)")
+
+    if writer is not None:
+        # Timed from the first disable, so the rate isn't diluted by the reads before it
+        write_seconds = time.monotonic() - write_start if write_start is not None else 0
+        logger.info(f"Disabled {disabled} keys in {write_seconds:.1f}s ({disabled / max(write_seconds, 0.001):.1f} calls/s)")
 
 
 
@@ -69,6 +110,37 @@ def disable_key(iam_client, key, username):
         return(False)
 
 
+def get_report_candidates(iam_client, threshold, path_prefix=None):
+    '''Yield the users from the credential report with an active key last used more than threshold days ago'''
+    cutoff = utc.localize(datetime.today() - timedelta(days=int(threshold)))
+    for row in get_credential_report(iam_client):
+        if row['user'] == '<root_account>' or not in_path(row['arn'], path_prefix):
+            continue
+        for n in ['1', '2']:
+            last_used_date = report_date(row[f'access_key_{n}_last_used_date'])
+            if row[f'access_key_{n}_active'] == 'true' and last_used_date is not None and last_used_date <= cutoff:
+                yield({'UserName': row['user']})
+                break
+
+
+def get_key_activity(iam_client, username, limiter):
+    '''Return username and a list of (AccessKeyId, get_access_key_last_used response) for each of their active keys'''
+    limiter.acquire()
+    key_activity = []
+    try:
+        keys = get_users_keys(iam_client, username)
+        for key in keys:
+            limiter.acquire()
+            key_activity.append((key, iam_client.get_access_key_last_used(AccessKeyId=key)))
+    except ClientError as e:
+        # The list of users may have come from the inventory cache, so the user (or key) may be gone
+        if e.response['Error']['Code'] != 'NoSuchEntity':
+            raise
+        logger.debug(f"User {username} or one of their keys no longer exists")
+        return(username, [])
+    return(username, key_activity)
+
+
 def get_users_keys(iam_client, username):
     '''Return Active Access keys for username'''
     keyids = []
@@ -80,18 +152,7 @@ def get_users_keys(iam_client, username):
     return(keyids)
 
 
-def get_all_users(iam_client):
-    '''Return an array of all IAM Users. '''
-    users = []
-    response = iam_client.list_users()
-    while 'IsTruncated' in response and response['IsTruncated'] is True:  # Gotta Catch 'em all!
-        users += response['Users']
-        response = iam_client.list_users(Marker=response['Marker'])
-    users += response['Users']
-    return(users)
-
-
-def do_args():
+def do_args(argv=None, known_only=False):
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", help="print debugging info", action='store_true')
@@ -100,8 +161,21 @@ def do_args():
     parser.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials)")
     parser.add_argument("--actually-do-it", help="Actually Perform the action", action='store_true')
     parser.add_argument("--threshold", help="Number of days of inactivity to disable. Default is 90 days", default=90)
-
-    args = parser.parse_args()
+    parser.add_argument("--path-prefix", help="Only Process Users under this IAM path, eg /division/")
+    parser.add_argument("--max-workers", help="Number of users to check in parallel. Default is 8", type=int, default=8)
+    parser.add_argument("--max-reads-per-second", help="Limit on IAM read calls per second across all workers. Default is 10", type=float, default=10)
+    parser.add_argument("--max-writes-per-second", help="Limit on IAM key disables per second. Default is 2", type=float, default=2)
+    parser.add_argument("--credential-report", help="Use the IAM credential report to find inactive users instead of checking every user", action='store_true')
+    parser.add_argument("--cache", help="Cache inventory (regions, buckets, users, keys) on disk between runs", action='store_true')
+    parser.add_argument("--refresh-cache", help="Ignore and replace any cached inventory", action='store_true')
+    parser.add_argument("--no-cache", help="Do not use the inventory cache, even if AWS_FAST_FIXES_CACHE is set", action='store_true')
+
+    if known_only:
+        # We are running alongside other fixes (see aws-fast-fixes.py), so leave their options to them,
+        # handing back whatever we didn't recognize as well
+        return(parser.parse_known_args(argv))
+    else:
+        args = parser.parse_args(argv)
 
     return(args)
 
@@ -137,5 +211,6 @@ if __name__ == '__main__':
 
     try:
         main(args, logger)
+        log_stats(logger)
     except KeyboardInterrupt:
         exit(1)
\ No newline at end of file
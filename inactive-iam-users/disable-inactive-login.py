@@ -3,41 +3,68 @@
 import boto3
 from botocore.exceptions import ClientError
 import os
+import sys
 import logging
 from datetime import datetime, timedelta
 import pytz
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fastfix.cache import get_cache
+from fastfix.clients import log_stats
+from fastfix.credreport import get_credential_report, report_date
+from fastfix.iamusers import get_all_users, in_path
+from fastfix.regions import region_client
 
 utc=pytz.UTC
 
-def main(args, logger):
+def main(args, logger, session=None):
     '''Executes the Primary Logic of the Fast Fix'''
 
     # If they specify a profile use it. Otherwise do the normal thing
-    if args.profile:
+    # (unless run-org-wide.py handed us a session for the account it is running the fix in)
+    if session is None and args.profile:
         session = boto3.Session(profile_name=args.profile)
-    else:
+    elif session is None:
         session = boto3.Session()
 
     # S3 is a global service and we can use any regional endpoint for this.
-    iam_client = session.client("iam")
-    for user in get_all_users(iam_client):
+    iam_client = region_client(session, "iam", None)
+    if args.credential_report:
+        # The credential report already tells us who has a password, so we only look at those users
+        users = get_report_users(iam_client, args.path_prefix)
+    else:
+        users = get_cache(session, args).get('global', f"list_users:{args.path_prefix}", lambda: get_all_users(iam_client, args.path_prefix))
+
+    for user in users:
         username = user['UserName']
 
         if 'PasswordLastUsed' not in user:
             logger.debug(f"User {username} has no PasswordLastUsed")
             continue
 
+        last_login = user['PasswordLastUsed']
+        utc=pytz.UTC  # We need to normalize the date & timezones
+        cutoff = utc.localize(datetime.today() - timedelta(days=int(args.threshold)))
+        if last_login > cutoff:
+            # Then we are good
+            logger.debug(f"{username} - last login {last_login} is OK")
+            continue
+
+        # The list of users may have come from the inventory cache, or from a credential report up to four hours old,
+        # so check the last login IAM has now
+        live_user = get_user(iam_client, username)
+        if live_user is None:
+            logger.debug(f"User {username} no longer exists")
+            continue
+        if live_user.get('PasswordLastUsed', last_login) > cutoff:
+            logger.debug(f"{username} - last login {live_user['PasswordLastUsed']} is OK")
+            continue
+
         # We need to make sure a Login Profile still exists (the PasswordLastUsed can be set on a removed LoginProfile)
         if not has_login_profile(iam_client, username):
             logger.debug(f"User {username} no longer has a LoginProfile")
             continue
 
-        last_login = user['PasswordLastUsed']
-        utc=pytz.UTC  # We need to normalize the date & timezones
-        if last_login > utc.localize(datetime.today() - timedelta(days=int(args.threshold))):
-            # Then we are good
-            logger.debug(f"{username} - last login {last_login} is OK")
-        elif args.actually_do_it is True:
+        if args.actually_do_it is True:
             # otherwise if we're configured to fix
             logger.info(f"Disabling Login for {username} - Last used {last_login}")
             disable_login(iam_client, username)
@@ -46,6 +73,29 @@ def main(args, logger):
             logger.info(f"Need to Disable login for {username} - Last used {last_login}")
 
 
+def get_report_users(iam_client, path_prefix=None):
+    '''Yield the users from the credential report who have a password, in the same shape as get_all_users'''
+    for row in get_credential_report(iam_client):
+        if row['user'] == '<root_account>' or row['password_enabled'] != 'true' or not in_path(row['arn'], path_prefix):
+            continue
+        user = {'UserName': row['user']}
+        password_last_used = report_date(row['password_last_used'])
+        if password_last_used is not None:
+            user['PasswordLastUsed'] = password_last_used
+        yield(user)
+
+
+def get_user(iam_client, username):
+    '''Return the user as IAM has it now, or None if they have been deleted'''
+    try:
+        return(iam_client.get_user(UserName=username)['User'])
+    except ClientError as e:
+        if e.response['Error']['Code'] == "NoSuchEntity":
+            return(None)
+        else:
+            raise
+
+
 def has_login_profile(iam_client, username):
     '''Confirms the user still has a login profile before we attempt to remove it'''
     try:
@@ -69,18 +119,7 @@ def disable_login(iam_client, username):
         return(False)
 
 
-def get_all_users(iam_client):
-    '''Return an array of all IAM Users. '''
-    users = []
-    response = iam_client.list_users()
-    while 'IsTruncated' in response and response['IsTruncated'] is True:  # Gotta Catch 'em all!
-        users += response['Users']
-        response = iam_client.list_users(Marker=response['Marker'])
-    users += response['Users']
-    return(users)
-
-
-def do_args():
+def do_args(argv=None, known_only=False):
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", help="print debugging info", action='store_true')
@@ -89,8 +128,18 @@ def do_args():
     parser.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials)")
     parser.add_argument("--actually-do-it", help="Actually Perform the action", action='store_true')
     parser.add_argument("--threshold", help="Number of days of inactivity to disable. Default is 90 days", default=90)
-
-    args = parser.parse_args()
+    parser.add_argument("--path-prefix", help="Only Process Users under this IAM path, eg /division/")
+    parser.add_argument("--credential-report", help="Use the IAM credential report to find inactive users instead of checking every user", action='store_true')
+    parser.add_argument("--cache", help="Cache inventory (regions, buckets, users, keys) on disk between runs", action='store_true')
+    parser.add_argument("--refresh-cache", help="Ignore and replace any cached inventory", action='store_true')
+    parser.add_argument("--no-cache", help="Do not use the inventory cache, even if AWS_FAST_FIXES_CACHE is set", action='store_true')
+
+    if known_only:
+        # We are running alongside other fixes (see aws-fast-fixes.py), so leave their options to them,
+        # handing back whatever we didn't recognize as well
+        return(parser.parse_known_args(argv))
+    else:
+        args = parser.parse_args(argv)
 
     return(args)
 
@@ -126,5 +175,6 @@ if __name__ == '__main__':
 
     try:
         main(args, logger)
+        log_stats(logger)
     except KeyboardInterrupt:
         exit(1)
\ No newline at end of file
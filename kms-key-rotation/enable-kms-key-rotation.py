@@ -3,46 +3,137 @@
 import boto3
 from botocore.exceptions import ClientError
 import os
+import sys
 import logging
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fastfix.clients import log_stats
+from fastfix.regions import run_regions, region_client, describe_regions
+from fastfix.cache import get_cache
+from concurrent.futures import ThreadPoolExecutor
 # logger = logging.getLogger()
 
-
-def main(args, logger):
+def main(args, logger, session=None):
     '''Executes the Primary Logic of the Fast Fix'''
 
     # If they specify a profile use it. Otherwise do the normal thing
-    if args.profile:
+    # (unless run-org-wide.py handed us a session for the account it is running the fix in)
+    if session is None and args.profile:
         session = boto3.Session(profile_name=args.profile)
-    else:
+    elif session is None:
         session = boto3.Session()
 
     # Get all the Regions for this account
     all_regions = get_regions(session, args)
 
-    for region in all_regions:
-        logger.debug(f"Processing {region}")
-        kms_client = session.client("kms", region_name=region)
-        keys = get_all_keys(kms_client)
-        for k in keys:
-            try:
-                status_response = kms_client.get_key_rotation_status(KeyId=k)
-                if 'KeyRotationEnabled' not in status_response:
-                    logger.error(f"Unable to get KeyRotationEnabled for keyid: {k}")
-                    continue
-                if status_response['KeyRotationEnabled']:
-                    logger.debug(f"KeyId {k} already has rotation enabled")
+    # Process the regions in parallel
+    run_regions(lambda region: process_region(args, region, session, logger), all_regions, logger, args.max_workers)
+
+
+def process_region(args, region, session, logger):
+    '''Check and fix the rotation status of every key in the region'''
+    logger.debug(f"Processing {region}")
+    kms_client = region_client(session, "kms", region)
+    keys = get_cache(session, args).get(region, 'list_keys', lambda: get_all_keys(kms_client))
+
+    # Customer rotation can't be enabled on AWS managed keys, so drop those we know about from their alias
+    aws_managed_keys = get_aws_managed_keys(kms_client)
+    customer_keys = [k for k in keys if k not in aws_managed_keys]
+    logger.debug(f"Skipping {len(keys) - len(customer_keys)} AWS managed keys in {region}")
+
+    keys = get_rotatable_keys(kms_client, customer_keys, args.key_workers, logger)
+    for k, status_response, error in get_key_rotation_statuses(kms_client, keys, args.key_workers):
+        try:
+            if error is not None:
+                raise error
+            if 'KeyRotationEnabled' not in status_response:
+                logger.error(f"Unable to get KeyRotationEnabled for keyid: {k}")
+                continue
+            if status_response['KeyRotationEnabled']:
+                logger.debug(f"KeyId {k} already has rotation enabled")
+            else:
+                if args.actually_do_it is True:
+                    logger.info(f"Enabling KMS Key Rotation on KeyId {k}")
+                    enable_key_rotation(kms_client, k)
                 else:
-                    if args.actually_do_it is True:
-                        logger.info(f"Enabling KMS Key Rotation on KeyId {k}")
-                        enable_key_rotation(kms_client, k)
-                    else:
-                        logger.info(f"You Need To Enable KMS Key Rotation on KeyId {k}")
-            except ClientError as e:
-                if e.response['Error']['Code'] == 'AccessDeniedException':
-                    logger.warning(f"Unable to get details of key {k} in {region}: AccessDenied")
-                    continue
-                else:
-                    raise
+                    logger.info(f"You Need To Enable KMS Key Rotation on KeyId {k}")
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'AccessDeniedException':
+                logger.warning(f"Unable to get details of key {k} in {region}: AccessDenied")
+                continue
+            elif e.response['Error']['Code'] == 'NotFoundException':
+                logger.debug(f"KeyId {k} in {region} no longer exists")
+                continue
+            else:
+                raise
+
+def get_rotatable_keys(kms_client, key_ids, max_workers, logger):
+    '''Return the KeyIds from key_ids that can have customer rotation enabled, keeping their order'''
+    # The list of keys may have come from the inventory cache, so some may have been deleted since
+    missing = set()
+
+    def get_metadata(KeyId):
+        try:
+            return(kms_client.describe_key(KeyId=KeyId)['KeyMetadata'])
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'AccessDeniedException':
+                return(None)  # Let the rotation status check report on this key
+            if e.response['Error']['Code'] == 'NotFoundException':
+                missing.add(KeyId)
+                return(None)
+            raise
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        all_metadata = list(executor.map(get_metadata, key_ids))
+
+    output = []
+    for KeyId, metadata in zip(key_ids, all_metadata):
+        if KeyId in missing:
+            logger.debug(f"KeyId {KeyId} no longer exists, skipping")
+            continue
+        reason = None if metadata is None else not_rotatable_reason(metadata)
+        if reason is not None:
+            logger.debug(f"KeyId {KeyId} {reason}, skipping")
+            continue
+        output.append(KeyId)
+    return(output)
+
+def not_rotatable_reason(metadata):
+    '''Return why the key described by metadata can't have customer rotation enabled, or None if it can'''
+    key_spec = metadata.get('KeySpec', metadata.get('CustomerMasterKeySpec', 'SYMMETRIC_DEFAULT'))
+    if metadata.get('KeyManager') == 'AWS':
+        return("is an AWS managed key")
+    if metadata.get('KeyState') in ['PendingDeletion', 'PendingReplicaDeletion']:
+        return("is pending deletion")
+    if key_spec != 'SYMMETRIC_DEFAULT':
+        return(f"is a {key_spec} key")
+    if metadata.get('Origin', 'AWS_KMS') != 'AWS_KMS':
+        return(f"has key material from {metadata['Origin']}")
+    if metadata.get('MultiRegionConfiguration', {}).get('MultiRegionKeyType') == 'REPLICA':
+        return("is a multi-region replica key")
+    return(None)
+
+def get_aws_managed_keys(kms_client):
+    '''Return a set of the KeyIds that have an AWS managed (alias/aws/*) alias in this region'''
+    key_ids = set()
+    paginator = kms_client.get_paginator('list_aliases')
+    for page in paginator.paginate():
+        for alias in page['Aliases']:
+            if alias['AliasName'].startswith('alias/aws/') and 'TargetKeyId' in alias:
+                key_ids.add(alias['TargetKeyId'])
+    return(key_ids)
+
+def get_key_rotation_statuses(kms_client, key_ids, max_workers):
+    '''Yield (KeyId, status_response, error) for each key in the order given, fetching up to max_workers at once.
+    Throttled calls are retried with backoff, any other ClientError is returned as error for the caller to handle'''
+    def get_status(KeyId):
+        try:
+            return(KeyId, kms_client.get_key_rotation_status(KeyId=KeyId), None)
+        except ClientError as e:
+            return(KeyId, None, e)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for result in executor.map(get_status, key_ids):
+            yield(result)
 
 def enable_key_rotation(kms_client, KeyId):
     '''Actually perform the enabling of Key rotation and checking of the status code'''
@@ -83,10 +174,9 @@ def get_regions(session, args):
         return([args.region])
 
     # otherwise return all the regions, us-east-1 first
-    ec2 = session.client('ec2')
-    response = ec2.describe_regions()
+    regions = describe_regions(session, args)
     output = ['us-east-1']
-    for r in response['Regions']:
+    for r in regions:
         # return us-east-1 first, but dont return it twice
         if r['RegionName'] == "us-east-1":
             continue
@@ -95,7 +185,7 @@ def get_regions(session, args):
 
 
 
-def do_args():
+def do_args(argv=None, known_only=False):
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", help="print debugging info", action='store_true')
@@ -104,8 +194,18 @@ def do_args():
     parser.add_argument("--region", help="Only Process Specified Region")
     parser.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials)")
     parser.add_argument("--actually-do-it", help="Actually Perform the action", action='store_true')
-
-    args = parser.parse_args()
+    parser.add_argument("--max-workers", help="Number of regions to process in parallel. Default is 10", type=int, default=10)
+    parser.add_argument("--key-workers", help="Number of keys to check in parallel in each region. Default is 8", type=int, default=8)
+    parser.add_argument("--cache", help="Cache inventory (regions, buckets, users, keys) on disk between runs", action='store_true')
+    parser.add_argument("--refresh-cache", help="Ignore and replace any cached inventory", action='store_true')
+    parser.add_argument("--no-cache", help="Do not use the inventory cache, even if AWS_FAST_FIXES_CACHE is set", action='store_true')
+
+    if known_only:
+        # We are running alongside other fixes (see aws-fast-fixes.py), so leave their options to them,
+        # handing back whatever we didn't recognize as well
+        return(parser.parse_known_args(argv))
+    else:
+        args = parser.parse_args(argv)
 
     return(args)
 
@@ -141,5 +241,6 @@ if __name__ == '__main__':
 
     try:
         main(args, logger)
+        log_stats(logger)
     except KeyboardInterrupt:
         exit(1)
\ No newline at end of file
@@ -4,7 +4,10 @@ import boto3
 from botocore.exceptions import ClientError
 # from botocore.errorfactory import BadRequestException
 import os
+import sys
 import logging
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fastfix.clients import make_client, log_stats
 # logger = logging.getLogger()
 
 services = {
@@ -22,7 +25,7 @@ def main(args, logger):
     else:
         session = boto3.Session()
 
-    org_client = session.client("organizations")
+    org_client = make_client(session, "organizations")
 
     for service, description in services.items():
 
@@ -91,5 +94,6 @@ if __name__ == '__main__':
 
     try:
         main(args, logger)
+        log_stats(logger)
     except KeyboardInterrupt:
         exit(1)
\ No newline at end of file
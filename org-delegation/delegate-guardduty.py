@@ -3,8 +3,13 @@
 import boto3
 from botocore.exceptions import ClientError
 # from botocore.errorfactory import BadRequestException
+import json
 import os
+import sys
 import logging
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fastfix.clients import log_stats
+from fastfix.regions import run_regions, region_client, describe_regions
 # logger = logging.getLogger()
 
 
@@ -19,24 +24,51 @@ def main(args, logger):
         session = boto3.Session()
 
     # GuardDuty needs to be enabled Regionally. Gah!
-    for r in get_regions(session, args):
-        guardduty_client = session.client("guardduty", region_name=r)
-        response = guardduty_client.list_organization_admin_accounts()
-        if len(response['AdminAccounts']) > 1:
-            logger.error(f"too many admin accounts in region {r}. Cannot proceed.")
-        elif len(response['AdminAccounts']) == 1:
-            if response['AdminAccounts'][0]['AdminAccountId'] == args.accountId:
-                logger.debug(f"Account {args.accountId} is already the delegated admin for region {r} and in state {response['AdminAccounts'][0]['AdminStatus']}")
-            else:
-                logger.error(f"{response['AdminAccounts'][0]['AdminAccountId']} is already the delegated admin in {r}. Not performing update")
-        elif args.actually_do_it is True:
-            try:
-                logger.info(f"Enablng GuardDuty Delegated Admin to {args.accountId} in region {r}")
-                guardduty_client.enable_organization_admin_account(AdminAccountId=args.accountId)
-            except ClientError as e:
-                logger.critical(e)
+    all_regions = get_regions(session, args)
+    results = run_regions(lambda r: process_region(args, r, session, logger), all_regions, logger, args.max_workers)
+
+    # One row per region of what we found or did, for whoever is onboarding the org
+    matrix = dict(results)
+    report = json.dumps({'DelegatedAdmin': args.accountId, 'Regions': matrix}, indent=2)
+    if args.output_file:
+        with open(args.output_file, 'w') as f:
+            f.write(report)
+        logger.info(f"Wrote results for {len(matrix)} regions to {args.output_file}")
+    else:
+        print(report)
+
+def process_region(args, r, session, logger):
+    '''Delegate GuardDuty admin to args.accountId in region r. Returns a dict with the Result for the region:
+    already-delegated, conflicting-admin, enabled, would-enable or error'''
+    guardduty_client = region_client(session, "guardduty", r)
+    try:
+        paginator = guardduty_client.get_paginator('list_organization_admin_accounts')
+        admin_accounts = list(paginator.paginate().search('AdminAccounts[]'))
+    except ClientError as e:
+        logger.error(f"Unable to list the GuardDuty delegated admins in region {r}: {e}")
+        return({'Result': 'error', 'Error': str(e)})
+
+    if len(admin_accounts) > 1:
+        logger.error(f"too many admin accounts in region {r}. Cannot proceed.")
+        return({'Result': 'conflicting-admin', 'AdminAccounts': admin_accounts})
+    elif len(admin_accounts) == 1:
+        if admin_accounts[0]['AdminAccountId'] == args.accountId:
+            logger.debug(f"Account {args.accountId} is already the delegated admin for region {r} and in state {admin_accounts[0]['AdminStatus']}")
+            return({'Result': 'already-delegated', 'AdminAccounts': admin_accounts})
         else:
-            logger.info(f"Would enable GuardDuty Delegated Admin to {args.accountId} in region {r}")
+            logger.error(f"{admin_accounts[0]['AdminAccountId']} is already the delegated admin in {r}. Not performing update")
+            return({'Result': 'conflicting-admin', 'AdminAccounts': admin_accounts})
+    elif args.actually_do_it is True:
+        try:
+            logger.info(f"Enablng GuardDuty Delegated Admin to {args.accountId} in region {r}")
+            guardduty_client.enable_organization_admin_account(AdminAccountId=args.accountId)
+            return({'Result': 'enabled'})
+        except ClientError as e:
+            logger.critical(e)
+            return({'Result': 'error', 'Error': str(e)})
+    else:
+        logger.info(f"Would enable GuardDuty Delegated Admin to {args.accountId} in region {r}")
+        return({'Result': 'would-enable'})
 
 def get_regions(session, args):
     '''Return a list of regions with us-east-1 first. If --region was specified, return a list wth just that'''
@@ -46,10 +78,9 @@ def get_regions(session, args):
         return([args.region])
 
     # otherwise return all the regions, us-east-1 first
-    ec2 = session.client('ec2')
-    response = ec2.describe_regions()
+    regions = describe_regions(session, args)
     output = ['us-east-1']
-    for r in response['Regions']:
+    for r in regions:
         # return us-east-1 first, but dont return it twice
         if r['RegionName'] == "us-east-1":
             continue
@@ -65,7 +96,12 @@ def do_args():
     parser.add_argument("--region", help="Only Process Specified Region")
     parser.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials)")
     parser.add_argument("--actually-do-it", help="Actually Perform the action", action='store_true')
+    parser.add_argument("--max-workers", help="Number of regions to process in parallel. Default is 10", type=int, default=10)
     parser.add_argument("--delegated-admin", dest='accountId', help="Delegate access to this account id", required=True)
+    parser.add_argument("--output-file", help="Write the per-region results as JSON to this file instead of stdout")
+    parser.add_argument("--cache", help="Cache inventory (regions, buckets, users, keys) on disk between runs", action='store_true')
+    parser.add_argument("--refresh-cache", help="Ignore and replace any cached inventory", action='store_true')
+    parser.add_argument("--no-cache", help="Do not use the inventory cache, even if AWS_FAST_FIXES_CACHE is set", action='store_true')
 
     args = parser.parse_args()
 
@@ -103,5 +139,6 @@ if __name__ == '__main__':
 
     try:
         main(args, logger)
+        log_stats(logger)
     except KeyboardInterrupt:
         exit(1)
\ No newline at end of file
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import boto3
+import copy
+import json
+import logging
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fastfix.clients import log_stats
+from fastfix.fixes import FIXES, load_fix
+from fastfix.org import AccountSessions, get_accounts, run_accounts
+from fastfix.regions import forget_session
+
+# Options of the fixes that name a file. Accounts run at the same time, so each gets its own file, named for the account
+PER_ACCOUNT_FILES = ['plan_file', 'apply_plan', 'filename']
+
+
+def main(args, logger):
+    '''Executes the Primary Logic'''
+
+    # If they specify a profile use it. Otherwise do the normal thing
+    if args.profile:
+        session = boto3.Session(profile_name=args.profile)
+    else:
+        session = boto3.Session()
+
+    # Parse the fix's own arguments once up front, so a typo fails now rather than in every account
+    fix_args = load_fix(args.fix).do_args(args.fix_args)
+
+    accounts = get_accounts(session)
+    if args.accounts:
+        accounts = [a for a in accounts if a['Id'] in args.accounts]
+    if args.exclude_accounts:
+        accounts = [a for a in accounts if a['Id'] not in args.exclude_accounts]
+    logger.info(f"Running {args.fix} in {len(accounts)} accounts, {args.max_accounts} at a time")
+
+    sessions = AccountSessions(session, args.role)
+    start = time.time()
+    results = run_accounts(lambda account, account_logger: run_fix(args.fix, fix_args, account, sessions, account_logger),
+                           accounts, logger, args.max_accounts)
+
+    report = {
+        'Fix': args.fix,
+        'FixArgs': args.fix_args,
+        'Role': args.role,
+        'Seconds': round(time.time() - start, 1),
+        'Accounts': [],
+    }
+    for account, result, error, seconds in results:
+        entry = {'AccountId': account['Id'], 'Name': account['Name'], 'Result': 'ok' if error is None else 'error', 'Seconds': round(seconds, 1)}
+        if error is not None:
+            entry['Error'] = repr(error)
+        report['Accounts'].append(entry)
+
+    failed = [a for a in report['Accounts'] if a['Result'] == 'error']
+    logger.info(f"Ran {args.fix} in {len(results)} accounts in {report['Seconds']} seconds, {len(failed)} failed")
+    report = json.dumps(report, indent=2)
+    if args.report_file:
+        with open(args.report_file, 'w') as f:
+            f.write(report)
+        logger.info(f"Wrote report to {args.report_file}")
+    else:
+        print(report)
+
+
+def run_fix(name, fix_args, account, sessions, logger):
+    '''Run the fix in account. Each account gets its own copy of the fix, so per-run caches aren't shared between accounts'''
+    logger.info(f"Running {name} in account {account['Id']} ({account['Name']})")
+    fix = load_fix(name)
+    fix_args = account_args(fix_args, account['Id'])
+    # Some fixes use the args & logger their __main__ would have set up
+    fix.args = fix_args
+    fix.logger = logger
+    try:
+        return(fix.main(fix_args, logger, session=sessions.get(account['Id'])))
+    finally:
+        # Let the account's session and its clients (each with a pool of connections) go, rather than holding every
+        # account's until the run ends
+        session = sessions.forget(account['Id'])
+        if session is not None:
+            forget_session(session)
+
+
+def account_args(fix_args, account_id):
+    '''Return a copy of fix_args with each file option made per account, eg plan.json becomes plan-111122223333.json'''
+    fix_args = copy.copy(fix_args)
+    for option in PER_ACCOUNT_FILES:
+        path = getattr(fix_args, option, None)
+        if path:
+            base, ext = os.path.splitext(path)
+            setattr(fix_args, option, f"{base}-{account_id}{ext}")
+    return(fix_args)
+
+
+def do_args():
+    import argparse
+    parser = argparse.ArgumentParser(description="Run a fast fix in every account of the AWS Organization")
+    parser.add_argument("--debug", help="print debugging info", action='store_true')
+    parser.add_argument("--error", help="print error info only", action='store_true')
+    parser.add_argument("--timestamp", help="Output log with timestamp and toolname", action='store_true')
+    parser.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials). Must be able to list the organization's accounts")
+    parser.add_argument("--role", help="Role to assume in each account. Default is OrganizationAccountAccessRole", default='OrganizationAccountAccessRole')
+    parser.add_argument("--accounts", nargs='+', help="Only run in these account ids")
+    parser.add_argument("--exclude-accounts", nargs='+', help="Do not run in these account ids")
+    parser.add_argument("--max-accounts", help="Number of accounts to process in parallel. Default is 8", type=int, default=8)
+    parser.add_argument("--report-file", help="Write the per-account results as JSON to this file instead of stdout")
+    parser.add_argument("fix", help="The fast fix to run", choices=sorted(FIXES))
+    parser.add_argument("fix_args", nargs=argparse.REMAINDER, help="Arguments for the fast fix (eg --actually-do-it --max-workers 4)")
+
+    args = parser.parse_args()
+
+    return(args)
+
+if __name__ == '__main__':
+
+    args = do_args()
+
+    # Logging idea stolen from: https://docs.python.org/3/howto/logging.html#configuring-logging
+    # create console handler and set level to debug
+    logger = logging.getLogger('run-org-wide')
+    ch = logging.StreamHandler()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+    elif args.error:
+        logger.setLevel(logging.ERROR)
+    else:
+        logger.setLevel(logging.INFO)
+
+    # Silence Boto3 & Friends
+    logging.getLogger('botocore').setLevel(logging.WARNING)
+    logging.getLogger('boto3').setLevel(logging.WARNING)
+    logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+    # create formatter. The logger name says which account a line is from
+    if args.timestamp:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    else:
+        formatter = logging.Formatter('%(levelname)s - %(name)s - %(message)s')
+    # add formatter to ch
+    ch.setFormatter(formatter)
+    # add ch to logger
+    logger.addHandler(ch)
+
+    try:
+        main(args, logger)
+        log_stats(logger)
+    except KeyboardInterrupt:
+        exit(1)
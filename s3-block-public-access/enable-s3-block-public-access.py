@@ -3,18 +3,30 @@
 import boto3
 from botocore.exceptions import ClientError
 import os
+import sys
 import json
 import logging
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fastfix.cache import get_cache
+from fastfix.clients import log_stats
+from fastfix.regions import region_client
+from fastfix.s3posture import collect_bucket_postures, get_pool
 # logger = logging.getLogger()
 
+# What we need to know about every bucket to decide if it needs fixing
+POSTURE_CALLS = ['public_access_block']
+# And what we need to know to decide if it is safe to fix, only asked of the buckets that need it
+SAFETY_CALLS = ['acl', 'policy', 'website']
 
-def main(args, logger):
+
+def main(args, logger, session=None):
     '''Executes the Primary Logic of the Fast Fix'''
 
     # If they specify a profile use it. Otherwise do the normal thing
-    if args.profile:
+    # (unless run-org-wide.py handed us a session for the account it is running the fix in)
+    if session is None and args.profile:
         session = boto3.Session(profile_name=args.profile)
-    else:
+    elif session is None:
         session = boto3.Session()
 
     # Open the command file for writing if we're supposed to do so
@@ -24,10 +36,17 @@ def main(args, logger):
         f = None
 
     # S3 is a global service and we can use any regional endpoint for this.
-    s3_client = session.client("s3")
-    for bucket in get_all_buckets(s3_client):
+    s3_client = region_client(session, "s3", None)
+    # The per-bucket calls go to the bucket's own region to avoid redirects. When the S3 fixes run together
+    # (see aws-fast-fixes.py) they share the pool, and with it the bucket list and the posture calls.
+    s3_pool = get_pool(session, max_connections=args.max_workers)
+    list_key = f"list_buckets:{args.bucket_prefix}:{args.bucket_region}"
+    buckets = s3_pool.once(list_key, lambda: get_cache(session, args).get('global', list_key, lambda: get_all_buckets(s3_client, args)))
+
+    for posture in collect_bucket_postures(s3_pool, buckets, POSTURE_CALLS, args.max_workers, SAFETY_CALLS, needs_fix):
+        bucket = posture.name
         try:
-            status_response = s3_client.get_public_access_block(Bucket=bucket)
+            status_response = posture.result('public_access_block')
             if 'PublicAccessBlockConfiguration' not in status_response:
                 logger.error(f"Unable to get PublicAccessBlockConfiguration for bucket: {bucket}. This is not expected and nothing will be done.")
                 continue
@@ -38,14 +57,18 @@ def main(args, logger):
                 logger.debug(f"Bucket {bucket} already has all four block public access settings enabled")
                 continue
             else:
-                fix_bucket(s3_client, bucket, args, f)
+                fix_bucket(s3_pool.client_for(bucket), posture, args, f)
                 continue
         except ClientError as e:
             if e.response['Error']['Code'] == 'NoSuchPublicAccessBlockConfiguration':
-                fix_bucket(s3_client, bucket, args, f)
+                fix_bucket(s3_pool.client_for(bucket), posture, args, f)
             elif e.response['Error']['Code'] == 'AccessDeniedException':
                 logger.warning(f"Unable to get details of key {bucket}: AccessDenied")
                 continue
+            elif e.response['Error']['Code'] == 'NoSuchBucket':
+                # The list of buckets may have come from the inventory cache
+                logger.debug(f"Bucket {bucket} no longer exists")
+                continue
             else:
                 raise
 
@@ -53,9 +76,20 @@ def main(args, logger):
     if args.filename:
         f.close()
 
-def fix_bucket(s3_client, bucket, args, f=None):
+def needs_fix(posture):
+    '''Return True if the bucket is missing any of the four block public access settings'''
+    try:
+        config = posture.result('public_access_block').get('PublicAccessBlockConfiguration')
+    except ClientError as e:
+        return(e.response['Error']['Code'] == 'NoSuchPublicAccessBlockConfiguration')
+    if config is None:
+        return(False)  # main() reports this one
+    return(not all(config.get(setting) is True for setting in ['BlockPublicAcls', 'IgnorePublicAcls', 'BlockPublicPolicy', 'RestrictPublicBuckets']))
+
+def fix_bucket(s3_client, posture, args, f=None):
     '''Determine if the Bucket is safe to fix. Do the fix or write the AWS CLI or just notify based on args '''
-    if not is_safe_to_fix_bucket(s3_client, bucket):
+    bucket = posture.name
+    if not is_safe_to_fix_bucket(posture):
         logger.warning(f"Bucket {bucket} has a bucket policy, conflicting ACLs or Website Hosting enabled which could conflict with Block Public Access. Not Enabling it.")
         return(False)
     elif args.actually_do_it is True:
@@ -75,16 +109,17 @@ def fix_bucket(s3_client, bucket, args, f=None):
         logger.info(f"You Need To Enable Block Public Access on {bucket}")
         return(True)
 
-def is_safe_to_fix_bucket(s3_client, bucket_name):
+def is_safe_to_fix_bucket(posture):
     '''Check ACLS and Policy to see if Bucket is safe to fix'''
-    return(is_safe_to_fix_by_acl(s3_client, bucket_name) and is_safe_to_fix_by_policy(s3_client, bucket_name) and is_safe_to_fix_by_bucket_website(s3_client, bucket_name))
+    return(is_safe_to_fix_by_acl(posture) and is_safe_to_fix_by_policy(posture) and is_safe_to_fix_by_bucket_website(posture))
 
 
-def is_safe_to_fix_by_acl(s3_client, bucket_name):
+def is_safe_to_fix_by_acl(posture):
     '''Inspect Bucket ACLS and determine if this bucket is safe to fix'''
+    bucket_name = posture.name
 
     try:
-        response = s3_client.get_bucket_acl(Bucket=bucket_name)
+        response = posture.result('acl')
         for grant in response['Grants']:
             if grant['Grantee']['Type'] == "Group":
                 if grant['Grantee']['URI'] == "http://acs.amazonaws.com/groups/global/AuthenticatedUsers":
@@ -96,11 +131,11 @@ def is_safe_to_fix_by_acl(s3_client, bucket_name):
         logger.error(f"ClientError getting Bucket {bucket_name} ACL: {e} ")
         return(False)  # Not Safe if we get this error
 
-def is_safe_to_fix_by_policy(s3_client, bucket_name):
+def is_safe_to_fix_by_policy(posture):
     '''Inspect the Bucket Policy to make sure there are no conditions granting access that could conflict with this'''
 
     try:
-        response = s3_client.get_bucket_policy(Bucket=bucket_name)
+        response = posture.result('policy')
         if 'Policy' in response:
             policy = json.loads(response['Policy'])
             for s in policy['Statement']:
@@ -121,11 +156,12 @@ def is_safe_to_fix_by_policy(s3_client, bucket_name):
         else:
             raise
 
-def is_safe_to_fix_by_bucket_website(s3_client, bucket_name):
+def is_safe_to_fix_by_bucket_website(posture):
     '''Inspect Bucket Website and determine if this bucket is safe to fix'''
+    bucket_name = posture.name
 
     try:
-        s3_client.get_bucket_website(Bucket=bucket_name)
+        posture.result('website')
         logger.warning(f"Bucket {bucket_name} is Hosting a Website!")
         return(False)  # Not Safe, Bucket Website Hosting enabled
     except ClientError as e:
@@ -153,13 +189,18 @@ def enable_block_public_access(s3_client, bucket_name):
         return(False)
 
 
-def get_all_buckets(s3_client):
-    '''Return an array of all S3 bucket names'''
-    buckets = []
-    response = s3_client.list_buckets()  # Don't paginate
-    for b in response['Buckets']:
-        buckets.append(b['Name'])
-    return(buckets)
+def get_all_buckets(s3_client, args):
+    '''Yield the Name and BucketRegion of each S3 bucket a page at a time, so checks can start before the listing is done'''
+    params = {'PaginationConfig': {'PageSize': 1000}}
+    if args.bucket_prefix:
+        params['Prefix'] = args.bucket_prefix
+    if args.bucket_region:
+        params['BucketRegion'] = args.bucket_region
+
+    paginator = s3_client.get_paginator('list_buckets')
+    for page in paginator.paginate(**params):
+        for b in page['Buckets']:
+            yield({'Name': b['Name'], 'BucketRegion': b.get('BucketRegion')})
 
 
 def get_regions(session, args):
@@ -170,7 +211,7 @@ def get_regions(session, args):
         return([args.region])
 
     # otherwise return all the regions, us-east-1 first
-    ec2 = session.client('ec2')
+    ec2 = region_client(session, 'ec2', None)
     response = ec2.describe_regions()
     output = ['us-east-1']
     for r in response['Regions']:
@@ -182,7 +223,7 @@ def get_regions(session, args):
 
 
 
-def do_args():
+def do_args(argv=None, known_only=False):
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", help="print debugging info", action='store_true')
@@ -191,8 +232,19 @@ def do_args():
     parser.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials)")
     parser.add_argument("--actually-do-it", help="Actually Perform the action", action='store_true')
     parser.add_argument("--output-script", dest="filename", help="Write CLI Commands to FILENAME for later execution")
-
-    args = parser.parse_args()
+    parser.add_argument("--max-workers", help="Number of buckets to check in parallel. Default is 16", type=int, default=16)
+    parser.add_argument("--bucket-prefix", help="Only Process Buckets whose name starts with this prefix")
+    parser.add_argument("--bucket-region", help="Only Process Buckets in this region")
+    parser.add_argument("--cache", help="Cache inventory (regions, buckets, users, keys) on disk between runs", action='store_true')
+    parser.add_argument("--refresh-cache", help="Ignore and replace any cached inventory", action='store_true')
+    parser.add_argument("--no-cache", help="Do not use the inventory cache, even if AWS_FAST_FIXES_CACHE is set", action='store_true')
+
+    if known_only:
+        # We are running alongside other fixes (see aws-fast-fixes.py), so leave their options to them,
+        # handing back whatever we didn't recognize as well
+        return(parser.parse_known_args(argv))
+    else:
+        args = parser.parse_args(argv)
 
     return(args)
 
@@ -228,5 +280,6 @@ if __name__ == '__main__':
 
     try:
         main(args, logger)
+        log_stats(logger)
     except KeyboardInterrupt:
         exit(1)
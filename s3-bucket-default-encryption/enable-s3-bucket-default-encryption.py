@@ -3,24 +3,43 @@
 import boto3
 from botocore.exceptions import ClientError
 import os
+import sys
 import logging
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fastfix.cache import get_cache
+from fastfix.clients import log_stats
+from fastfix.regions import region_client
+from fastfix.s3posture import collect_bucket_postures, get_pool
 # logger = logging.getLogger()
 
+# What we need to know about every bucket to decide if it needs fixing
+POSTURE_CALLS = ['encryption']
+# And what we need to know to decide if it is safe to fix, only asked of the buckets that need it
+SAFETY_CALLS = ['policy']
 
-def main(args, logger):
+
+def main(args, logger, session=None):
     '''Executes the Primary Logic of the Fast Fix'''
 
     # If they specify a profile use it. Otherwise do the normal thing
-    if args.profile:
+    # (unless run-org-wide.py handed us a session for the account it is running the fix in)
+    if session is None and args.profile:
         session = boto3.Session(profile_name=args.profile)
-    else:
+    elif session is None:
         session = boto3.Session()
 
     # S3 is a global service and we can use any regional endpoint for this.
-    s3_client = session.client("s3")
-    for bucket in get_all_buckets(s3_client):
+    s3_client = region_client(session, "s3", None)
+    # The per-bucket calls go to the bucket's own region to avoid redirects. When the S3 fixes run together
+    # (see aws-fast-fixes.py) they share the pool, and with it the bucket list and the posture calls.
+    s3_pool = get_pool(session, max_connections=args.max_workers)
+    list_key = f"list_buckets:{args.bucket_prefix}:{args.bucket_region}"
+    buckets = s3_pool.once(list_key, lambda: get_cache(session, args).get('global', list_key, lambda: get_all_buckets(s3_client, args)))
+
+    for posture in collect_bucket_postures(s3_pool, buckets, POSTURE_CALLS, args.max_workers, SAFETY_CALLS, needs_fix):
+        bucket = posture.name
         try:
-            status_response = s3_client.get_bucket_encryption(Bucket=bucket)
+            status_response = posture.result('encryption')
             if 'ServerSideEncryptionConfiguration' not in status_response and 'Rules' not in status_response['ServerSideEncryptionConfiguration']:
                 logger.error(f"Unable to get ServerSideEncryptionConfiguration for bucket: {bucket}")
                 continue
@@ -32,27 +51,35 @@ def main(args, logger):
                 continue
         except ClientError as e:
             if e.response['Error']['Code'] == 'ServerSideEncryptionConfigurationNotFoundError':
-                if not is_safe_to_fix_bucket(s3_client, bucket):
+                if not is_safe_to_fix_bucket(posture):
                     logger.warning(f"Bucket {bucket} has a bucket policy that could conflict with Default Encryption. Not Enabling it.")
                     continue
                 elif args.actually_do_it is True:
                     logger.info(f"Enabling Default Encryption on {bucket}")
-                    enable_bucket_encryption(s3_client, bucket)
+                    enable_bucket_encryption(s3_pool.client_for(bucket), bucket)
                 else:
                     logger.info(f"You Need To Enable Default Encryption on {bucket}")
             elif e.response['Error']['Code'] == 'AccessDeniedException':
                 logger.warning(f"Unable to get details of key {bucket}: AccessDenied")
                 continue
+            elif e.response['Error']['Code'] == 'NoSuchBucket':
+                # The list of buckets may have come from the inventory cache
+                logger.debug(f"Bucket {bucket} no longer exists")
+                continue
             else:
                 raise
 
-def is_safe_to_fix_bucket(s3_client, bucket_name):
+def needs_fix(posture):
+    '''Return True if the bucket has no default encryption'''
+    return('encryption' in posture.errors and posture.errors['encryption'].response['Error']['Code'] == 'ServerSideEncryptionConfigurationNotFoundError')
+
+def is_safe_to_fix_bucket(posture):
     '''Inspect the Bucket Policy to make sure there are no conditions requiring encryption that could conflict with this'''
 
     match_strings = [ 'x-amz-server-side-encryption', 'x-amz-server-side-encryption-aws-kms-key-id']
 
     try:
-        response = s3_client.get_bucket_policy(Bucket=bucket_name)
+        response = posture.result('policy')
         if 'Policy' in response:
             policy_str = response['Policy']
             for condition in match_strings:
@@ -84,13 +111,18 @@ def enable_bucket_encryption(s3_client, bucket_name):
         return(False)
 
 
-def get_all_buckets(s3_client):
-    '''Return an array of all S3 bucket names'''
-    buckets = []
-    response = s3_client.list_buckets()  # Don't paginate
-    for b in response['Buckets']:
-        buckets.append(b['Name'])
-    return(buckets)
+def get_all_buckets(s3_client, args):
+    '''Yield the Name and BucketRegion of each S3 bucket a page at a time, so checks can start before the listing is done'''
+    params = {'PaginationConfig': {'PageSize': 1000}}
+    if args.bucket_prefix:
+        params['Prefix'] = args.bucket_prefix
+    if args.bucket_region:
+        params['BucketRegion'] = args.bucket_region
+
+    paginator = s3_client.get_paginator('list_buckets')
+    for page in paginator.paginate(**params):
+        for b in page['Buckets']:
+            yield({'Name': b['Name'], 'BucketRegion': b.get('BucketRegion')})
 
 
 def get_regions(session, args):
@@ -101,7 +133,7 @@ def get_regions(session, args):
         return([args.region])
 
     # otherwise return all the regions, us-east-1 first
-    ec2 = session.client('ec2')
+    ec2 = region_client(session, 'ec2', None)
     response = ec2.describe_regions()
     output = ['us-east-1']
     for r in response['Regions']:
@@ -113,7 +145,7 @@ def get_regions(session, args):
 
 
 
-def do_args():
+def do_args(argv=None, known_only=False):
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", help="print debugging info", action='store_true')
@@ -121,8 +153,19 @@ def do_args():
     parser.add_argument("--timestamp", help="Output log with timestamp and toolname", action='store_true')
     parser.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials)")
     parser.add_argument("--actually-do-it", help="Actually Perform the action", action='store_true')
-
-    args = parser.parse_args()
+    parser.add_argument("--max-workers", help="Number of buckets to check in parallel. Default is 16", type=int, default=16)
+    parser.add_argument("--bucket-prefix", help="Only Process Buckets whose name starts with this prefix")
+    parser.add_argument("--bucket-region", help="Only Process Buckets in this region")
+    parser.add_argument("--cache", help="Cache inventory (regions, buckets, users, keys) on disk between runs", action='store_true')
+    parser.add_argument("--refresh-cache", help="Ignore and replace any cached inventory", action='store_true')
+    parser.add_argument("--no-cache", help="Do not use the inventory cache, even if AWS_FAST_FIXES_CACHE is set", action='store_true')
+
+    if known_only:
+        # We are running alongside other fixes (see aws-fast-fixes.py), so leave their options to them,
+        # handing back whatever we didn't recognize as well
+        return(parser.parse_known_args(argv))
+    else:
+        args = parser.parse_args(argv)
 
     return(args)
 
@@ -158,5 +201,6 @@ if __name__ == '__main__':
 
     try:
         main(args, logger)
+        log_stats(logger)
     except KeyboardInterrupt:
         exit(1)
\ No newline at end of file
@@ -1,10 +1,21 @@
 #!/bin/env python3
 import boto3
 from botocore.exceptions import ClientError
-from collections import OrderedDict
 import argparse
 import logging
 import json
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fastfix.clients import log_stats
+from fastfix.pool import ordered_map
+from fastfix.regions import region_client, describe_regions
+
+# Instance profiles are shared by many instances, so each is resolved to its role (and each role to its policies) once per run
+role_name_cache = {}
+role_policy_cache = {}
+# The account each session belongs to. Clients come from region_client(), which builds each one once
+account_cache = {}
 
 def get_regions(session, args):
     '''Return a list of regions with us-east-1 first. If --region was specified, return a list wth just that'''
@@ -14,50 +25,59 @@ def get_regions(session, args):
         return([args.region])
 
     # otherwise return all the regions, us-east-1 first
-    ec2 = session.client('ec2')
-    response = ec2.describe_regions()
+    regions = describe_regions(session, args)
     output = ['us-east-1']
-    for r in response['Regions']:
+    for r in regions:
         # return us-east-1 first, but dont return it twice
         if r['RegionName'] == "us-east-1":
             continue
         output.append(r['RegionName'])
     return(output)
 
-def format_tags(item: dict, tags='Tags'):
-    '''Returns dict of tags or empty dict'''
-    tags_list = item.get(tags)
-    return OrderedDict(sorted([(tag.get('Key'), tag.get('Value')) for tag in tags_list])) if tags_list is not None else OrderedDict()
-
-def get_ec2(session, regions, state='running'):
-    '''Generator for all running ec2 instances'''
-    for region in regions:
-        ec2 = session.client('ec2', region_name=region)
-        reservations = ec2.describe_instances(Filters=[{'Name': 'instance-state-name', 'Values': [state]}])['Reservations']
-        for reservation in reservations:
-            for instance in reservation['Instances']:
-                instance['Region'] = region
-                instance['Tags'] = format_tags(instance)
-                instance['Name'] = instance['Tags'].get('Name', '')
-                yield instance
+# Only the parts of each instance that attach_role and audit_role need
+INSTANCE_FIELDS = "Reservations[].Instances[].{InstanceId: InstanceId, Name: Tags[?Key=='Name'].Value | [0], InstanceProfileArn: IamInstanceProfile.Arn}"
+
+def get_region_instances(session, region, state='running'):
+    '''Return slim records for the instances in state in region'''
+    ec2 = region_client(session, 'ec2', region)
+    paginator = ec2.get_paginator('describe_instances')
+    # There is no filter for instances *without* an instance profile, so every instance is listed and sorted out by the caller
+    pages = paginator.paginate(Filters=[{'Name': 'instance-state-name', 'Values': [state]}], PaginationConfig={'PageSize': 1000})
+    instances = []
+    for instance in pages.search(INSTANCE_FIELDS):
+        instance['Name'] = instance['Name'] or ''
+        instance['Region'] = region
+        instances.append(instance)
+    return(instances)
+
+def get_ec2(session, regions, state='running', max_workers=10):
+    '''Generator for all running ec2 instances, scanning up to max_workers regions at once'''
+    for instances in ordered_map(lambda region: get_region_instances(session, region, state), regions, max_workers):
+        yield from instances
 
 def get_account(session):
-    '''Returns AWS account'''
-    return session.client('sts').get_caller_identity().get('Account')
+    '''Returns AWS account, calling sts only once per session'''
+    if id(session) not in account_cache:
+        account_cache[id(session)] = region_client(session, 'sts', None).get_caller_identity().get('Account')
+    return account_cache[id(session)]
 
 def get_role_name(session, profile_name):
-    ''' Returns the instance profile'''
-    return session.client('iam').get_instance_profile(InstanceProfileName=profile_name)['InstanceProfile']['Roles'][0]['RoleName']
+    ''' Returns the instance profile's role, looking it up only the first time we see the profile'''
+    if profile_name not in role_name_cache:
+        role_name_cache[profile_name] = region_client(session, 'iam', None).get_instance_profile(InstanceProfileName=profile_name)['InstanceProfile']['Roles'][0]['RoleName']
+    return role_name_cache[profile_name]
 
 def get_role_policy(session, role_name):
-    '''Returns list of policies attached to role'''
-    policies = session.client('iam').list_attached_role_policies(RoleName=role_name)['AttachedPolicies']
-    return [p.get('PolicyArn') for p in policies]
+    '''Returns list of policies attached to role, looking them up only the first time we see the role'''
+    if role_name not in role_policy_cache:
+        paginator = region_client(session, 'iam', None).get_paginator('list_attached_role_policies')
+        role_policy_cache[role_name] = list(paginator.paginate(RoleName=role_name).search('AttachedPolicies[].PolicyArn'))
+    return role_policy_cache[role_name]
 
 def attach_instance_profile(session, instance_id, region, profile_name):
     '''Attaches instance profile to e2 instance'''
     account = get_account(session)
-    session.client('ec2', region_name=region).associate_iam_instance_profile(
+    region_client(session, 'ec2', region).associate_iam_instance_profile(
         IamInstanceProfile={
             "Arn" :  f"arn:aws:iam::{account}:instance-profile/{profile_name}",
             "Name": profile_name
@@ -67,15 +87,17 @@ def attach_instance_profile(session, instance_id, region, profile_name):
 
 def attach_policy_to_role(session, role_name, policy_arn):
     '''Attaches policy to role'''
-    session.client('iam').attach_role_policy(RoleName=role_name, PolicyArn=policy_arn)
+    region_client(session, 'iam', None).attach_role_policy(RoleName=role_name, PolicyArn=policy_arn)
+    # Record the change, so the next instance with this role sees it without asking IAM again
+    get_role_policy(session, role_name).append(policy_arn)
 
 def attach_role(session, instance_id, instance_name, region, role_name, args):
     '''Attaches IAM instance profile (role) to ec2 instance'''
     if args.actually_do_it:
-        logging.info(f"InstanceId: {instance_id}, Name: {instance_name} attaching IAM Role: {role_name}")
+        logger.info(f"InstanceId: {instance_id}, Name: {instance_name} attaching IAM Role: {role_name}")
         attach_instance_profile(session, instance_id, region, role_name)
     else:
-        logging.warning(f"InstanceId: {instance_id}, Name: {instance_name} has no IAM Role attached.  Will attach IAM Role: {role_name}")
+        logger.warning(f"InstanceId: {instance_id}, Name: {instance_name} has no IAM Role attached.  Will attach IAM Role: {role_name}")
 
 def audit_role(session, instance_id, instance_name, instance_profile, policy_arn, actually_do_it):
     '''Audit role already attached to instance to ensure policy is present'''
@@ -84,12 +106,12 @@ def audit_role(session, instance_id, instance_name, instance_profile, policy_arn
 
     if policy_arn not in policies:
         if args.actually_do_it and args.also_attach_to_existing_roles:
-            logging.info(f"Role: {role_name}, Instance Profile {instance_profile}, attaching {policy_arn}")
+            logger.info(f"Role: {role_name}, Instance Profile {instance_profile}, attaching {policy_arn}")
             attach_policy_to_role(session, role_name, policy_arn)
         else:
-            logging.warning(f"Role: {role_name}, Instance Profile {instance_profile}, InstanceId: {instance_id}, Name: {instance_name} does not have {policy_arn} attached")
+            logger.warning(f"Role: {role_name}, Instance Profile {instance_profile}, InstanceId: {instance_id}, Name: {instance_name} does not have {policy_arn} attached")
 
-def do_args():
+def do_args(argv=None, known_only=False):
     '''Returns command line args'''
     parser = argparse.ArgumentParser()
     parser.add_argument("--region", help="Only Process Specified Region")
@@ -98,7 +120,16 @@ def do_args():
     parser.add_argument("--policy", help="Policy arn to attach to role if instance already has IAM profile attached to ec2", default='arn:aws:iam::aws:policy/AmazonSSMManagedInstanceCore')
     parser.add_argument("--actually-do-it", help="Actually Perform the action", action='store_true')
     parser.add_argument("--also-attach-to-existing-roles", help="Adds permissions to existing roles", action='store_true')
-    args = parser.parse_args()
+    parser.add_argument("--max-workers", help="Number of regions to scan for instances in parallel. Default is 10", type=int, default=10)
+    parser.add_argument("--cache", help="Cache inventory (regions, buckets, users, keys) on disk between runs", action='store_true')
+    parser.add_argument("--refresh-cache", help="Ignore and replace any cached inventory", action='store_true')
+    parser.add_argument("--no-cache", help="Do not use the inventory cache, even if AWS_FAST_FIXES_CACHE is set", action='store_true')
+    if known_only:
+        # We are running alongside other fixes (see aws-fast-fixes.py), so leave their options to them,
+        # handing back whatever we didn't recognize as well
+        return(parser.parse_known_args(argv))
+    else:
+        args = parser.parse_args(argv)
     return(args)
 
 def create_ssm_role(session, role_name, policy_arn, args):
@@ -106,9 +137,9 @@ def create_ssm_role(session, role_name, policy_arn, args):
         get_role_name(session, role_name)
     except:
         if args.actually_do_it:
-            logging.info(f"Creating Role: {role_name}, Instance Profile: {role_name}, Policy {policy_arn}")
+            logger.info(f"Creating Role: {role_name}, Instance Profile: {role_name}, Policy {policy_arn}")
 
-            iam = session.client('iam')
+            iam = region_client(session, 'iam', None)
             trust_policy={
                 "Version": "2012-10-17",
                 "Statement": [
@@ -149,33 +180,46 @@ def create_ssm_role(session, role_name, policy_arn, args):
             )
             attach_policy_to_role(session, role_name, policy_arn)
         else:
-            logging.warning(f"Role: {role_name}, Instance Profile: {role_name}, Policy {policy_arn} will be created")
+            logger.warning(f"Role: {role_name}, Instance Profile: {role_name}, Policy {policy_arn} will be created")
+
+def main(args, logger, session=None):
+    '''Executes the Primary Logic of the Fast Fix'''
+
+    # If they specify a profile use it. Otherwise do the normal thing
+    # (unless run-org-wide.py handed us a session for the account it is running the fix in)
+    if session is None and args.profile:
+        session = boto3.Session(profile_name=args.profile)
+    elif session is None:
+        session = boto3.Session()
+
+    create_ssm_role(session, args.role, args.policy, args)
+    regions = get_regions(session, args)
+    for instance in get_ec2(session, regions, state="running", max_workers=args.max_workers):
+        instance_id = instance['InstanceId']
+        instance_name = instance['Name']
+        region = instance['Region']
+        if not instance['InstanceProfileArn']:
+            attach_role(session, instance_id, instance_name, region, args.role, args)
+        else:
+            instance_profile = instance['InstanceProfileArn'].split('instance-profile/')[-1]
+            audit_role(session, instance_id, instance_name, instance_profile, args.policy, args)
 
 if __name__ == '__main__':
+    args = do_args()
+
     # logging
+    logger = logging.getLogger('ssm-role')
+    logger.setLevel(logging.INFO)
+    ch = logging.StreamHandler()
     formatter = logging.Formatter('%(levelname)s - %(message)s')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
     logging.getLogger('botocore').setLevel(logging.WARNING)
     logging.getLogger('boto3').setLevel(logging.WARNING)
     logging.getLogger('urllib3').setLevel(logging.WARNING)
 
-    # aws
-    args = do_args()
-    if args.profile:
-        session = boto3.Session(profile_name=args.profile)
-    else:
-        session = boto3.Session()
-
     try:
-        create_ssm_role(session, args.role, args.policy, args)
-        regions = get_regions(session, args)
-        for instance in get_ec2(session, regions, state="running"):
-            instance_id = instance.get('InstanceId')
-            instance_name = instance.get('Name')
-            region = instance.get('Region')
-            if 'IamInstanceProfile' not in instance:
-                attach_role(session, instance_id, instance_name, region, args.role, args)
-            else:
-                instance_profile = instance['IamInstanceProfile']['Arn'].split('instance-profile/')[-1]
-                audit_role(session, instance_id, instance_name, instance_profile, args.policy, args)
+        main(args, logger)
+        log_stats(logger)
     except KeyboardInterrupt:
         exit(1)
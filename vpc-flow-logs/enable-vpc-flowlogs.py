@@ -2,29 +2,93 @@
 
 import boto3
 from botocore.exceptions import ClientError
+import json
 import logging
-
-def main(args, logger):
+import os
+import sys
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fastfix.clients import log_stats
+from fastfix.regions import run_regions, region_client, describe_regions
+
+# CreateFlowLogs and DeleteFlowLogs take up to 1000 VPC or flow log IDs per call
+FLOWLOG_BATCH_SIZE = 1000
+
+def main(args, logger, session=None):
     '''Executes the Primary Logic'''
 
     # If they specify a profile use it. Otherwise do the normal thing
-    if args.profile:
+    # (unless run-org-wide.py handed us a session for the account it is running the fix in)
+    if session is None and args.profile:
         session = boto3.Session(profile_name=args.profile)
-    else:
+    elif session is None:
         session = boto3.Session()
 
+    if args.apply_plan:
+        # Apply a plan written by --plan-file earlier, without looking at the VPCs again
+        with open(args.apply_plan) as f:
+            plan = json.load(f)
+        logger.info(f"Applying plan {args.apply_plan} from {plan['created']}")
+        run_regions(lambda region: apply_region(plan['regions'][region], plan['bucket'], plan['traffic_type'], args, region, session, logger),
+                    list(plan['regions']), logger, args.max_workers)
+        return
+
     # Get all the Regions for this account
     all_regions = get_regions(session, args)
 
-    # processiong regions
-    for region in all_regions:
-        process_region(args, region, session, logger)
+    # processiong regions in parallel
+    results = run_regions(lambda region: plan_region(args, region, session, logger), all_regions, logger, args.max_workers)
+    bucket = 'arn:aws:s3:::{}'.format(args.flowlog_bucket)
+
+    if args.plan_file:
+        plan = {
+            'created': datetime.now(timezone.utc).isoformat(),
+            'bucket': bucket,
+            'traffic_type': args.traffic_type,
+            'regions': dict((region, region_plan) for region, region_plan in results if region_plan['create'] or region_plan['delete'])
+        }
+        with open(args.plan_file, 'w') as f:
+            json.dump(plan, f, indent=2)
+        logger.info("Wrote plan with {} flow logs to create and {} to delete to {}".format(
+            sum(len(p['create']) for p in plan['regions'].values()),
+            sum(len(p['delete']) for p in plan['regions'].values()),
+            args.plan_file))
+        return
+
+    plans = dict((region, region_plan) for region, region_plan in results if region_plan['create'] or region_plan['delete'])
+    if args.actually_do_it and not args.force:
+        # Ask here, now every region's log is written, rather than from the region workers
+        plans = confirm_replacements(plans, logger)
+    run_regions(lambda region: apply_region(plans[region], bucket, args.traffic_type, args, region, session, logger),
+                list(plans), logger, args.max_workers)
 
     return
 
-def process_region(args, region, session, logger):
+def confirm_replacements(plans, logger):
+    '''Ask before each flow log in plans is replaced. Returns plans without the replacements that were declined'''
+    confirmed = {}
+    for region, region_plan in plans.items():
+        to_delete = []
+        for d in region_plan['delete']:
+            logger.info("Flow Log {} in region:{}, VPC:{} will be terminated and a new flow log created with these changes:\n\t{}".format(
+                d['FlowLogId'], region, d['VpcId'], d['Changes']))
+            if input('Do you wish to continue? [y/N] ').lower()[:1] == 'y':
+                to_delete.append(d)
+            else:
+                logger.info("User declined replacement of flow log {}".format(d['FlowLogId']))
+        # A VPC only gets its replacement flow log if at least one of its old ones is going
+        declined_vpcs = set(d['VpcId'] for d in region_plan['delete']) - set(d['VpcId'] for d in to_delete)
+        create = [VpcId for VpcId in region_plan['create'] if VpcId not in declined_vpcs]
+        if create or to_delete:
+            confirmed[region] = {'create': create, 'delete': to_delete}
+    return(confirmed)
+
+
+def plan_region(args, region, session, logger):
+    '''Return the plan for region: the VPCs needing a flow log created, and the flow logs to delete and replace'''
     logger.info(f"Processing region {region}")
-    ec2_client = session.client('ec2', region_name=region)
+    ec2_client = region_client(session, 'ec2', region)
     vpcs = []
     paginator = ec2_client.get_paginator('describe_vpcs')
     for page in paginator.paginate():
@@ -34,127 +98,163 @@ def process_region(args, region, session, logger):
                     vpcs.append(vpc['VpcId'])
             else:
                 vpcs.append(vpc['VpcId'])
+    region_plan = {'create': [], 'delete': []}
     if vpcs:
+        eni_count = get_eni_count(ec2_client, vpcs)
+        flowlog_index = get_flowlog_index(ec2_client)
         # processing VPCs
         for VpcId in vpcs:
             # enable flowlogs if the vpc has eni within it
             logger.debug(f"   Processing VpcId {VpcId}")
-            network_interfaces = ec2_client.describe_network_interfaces(Filters=[{'Name':'vpc-id','Values':[VpcId]}])['NetworkInterfaces']
-            if network_interfaces:
+            if eni_count[VpcId]:
                 logger.debug(f"   ENI found in VpcId {VpcId}")
-                enable_flowlogs(VpcId, ec2_client, args, region)
+                create, delete = enable_flowlogs(VpcId, flowlog_index, args, region)
+                region_plan['create'] += create
+                region_plan['delete'] += delete
             else:
                 logger.debug(f"   No ENI found in VpcId {VpcId}, skipped.")
     else:
         logger.debug("   No VPCs to enable flow logs in region:{}".format(region))
 
+    return(region_plan)
+
+
+def apply_region(region_plan, bucket, traffic_type, args, region, session, logger):
+    '''Make the changes in region_plan'''
+    logger.debug(f"Applying changes in region {region}")
+    ec2_client = region_client(session, 'ec2', region)
+    # Replaced flow logs have to go before their replacements can be created
+    failed_vpcs = delete_flowlogs([(d['VpcId'], d['FlowLogId']) for d in region_plan['delete']], ec2_client, args, region)
+    create_flowlogs([VpcId for VpcId in region_plan['create'] if VpcId not in failed_vpcs], bucket, traffic_type, ec2_client, args, region)
     return
 
 
-def enable_flowlogs(VpcId,client,args,region):
-    # checking for existing flow logs
-    bucket = 'arn:aws:s3:::{}'.format(args.flowlog_bucket)
+def get_eni_count(client, vpcs):
+    '''Return a Counter of ENIs by VpcId for the VPCs in vpcs'''
+    if len(vpcs) == 1:
+        # For a single VPC we only need to know if there are any ENIs, so ask for the smallest pages allowed.
+        # A filtered page can come back empty with more to follow, so stop at the first page that has any.
+        paginator = client.get_paginator('describe_network_interfaces')
+        for page in paginator.paginate(Filters=[{'Name':'vpc-id','Values':vpcs}], PaginationConfig={'PageSize': 5}):
+            if page['NetworkInterfaces']:
+                return(Counter({vpcs[0]: len(page['NetworkInterfaces'])}))
+        return(Counter())
+
+    # Otherwise one sweep of the region is far fewer calls than one per VPC. Only the VpcId of each ENI is kept.
+    paginator = client.get_paginator('describe_network_interfaces')
+    return(Counter(paginator.paginate(PaginationConfig={'PageSize': 1000}).search('NetworkInterfaces[].VpcId')))
+
+
+def get_flowlog_index(client):
+    '''Return a dict of the region's S3 flow logs, as lists keyed by (ResourceId, LogDestination)'''
+    flowlog_index = defaultdict(list)
     paginator = client.get_paginator('describe_flow_logs')
-    for page in paginator.paginate(
-            Filters=[
-                {
-                    'Name': 'resource-id',
-                    'Values': [VpcId]
-                },
-                {
-                    'Name': 'log-destination-type',
-                    'Values': ['s3']
-                }
-            ]
-        ):
-        
-        if page['FlowLogs']:
-
-            for FlowLog in page['FlowLogs']:
-                if FlowLog['LogDestination'] == bucket:
-                    
-                    accept_destructive_update=False
-
-                    logger.debug("   Flow Log ({}) already exist, region:{}, VPC:{}".format(FlowLog['FlowLogId'],region,VpcId))
-                    if FlowLog['DeliverLogsStatus'] == 'FAILED':
-                        logger.error("Flow Log ({}) failed, region:{}, VPC:{}, please check it".format(FlowLog['FlowLogId'],region,VpcId))
-                        return
-
-                    logger.debug("Flow Log ({}) is {} on {}\n   traffic type: {}\n   destination type: {}\n   destination: {}\n   log format: \n   {}".format(
-                        FlowLog['FlowLogId'],
-                        FlowLog['FlowLogStatus'],
-                        FlowLog['ResourceId'],
-                        FlowLog['TrafficType'],
-                        FlowLog['LogDestinationType'],
-                        FlowLog['LogDestination'],
-                        FlowLog['LogFormat']
-                    ))
-
-                    difflist = []
-                    if FlowLog['TrafficType'] != args.traffic_type:
-                        difflist.append("Traffic type will change from {} to {}.".format(FlowLog['TrafficType'],args.traffic_type))
-                    if FlowLog['LogDestination'] != bucket:
-                        difflist.append("Log Destination will change from {} to {}.".format(FlowLog['LogDestination'],bucket))
-
-                    if difflist == []:
-                        # No actions to perform here
-                        continue
-
-                    logger.info("Existing flow log will be terminated and new flow log created with these changes:\n\t{}\n".format(difflist))
-
-                    if args.force:
-                        accept_destructive_update='y'
-                    else:
-                        accept_destructive_update = input(f'Do you wish to continue? [y/N] ').lower()
-                    if accept_destructive_update[:1] == 'y':
-                        delete_flowlog(VpcId,FlowLog['FlowLogId'],True,client,args,region)
-                        create_flowlog(VpcId,bucket,client,args,region)
-                    else:
-                        logger.info("User declined replacement of flow log {}".format(FlowLog['FlowLogId']))
-                else:
-                    create_flowlog(VpcId,bucket,client,args,region)
-        else:
-            create_flowlog(VpcId,bucket,client,args,region)
+    for page in paginator.paginate(Filters=[{'Name': 'log-destination-type', 'Values': ['s3']}]):
+        for FlowLog in page['FlowLogs']:
+            flowlog_index[(FlowLog['ResourceId'], FlowLog['LogDestination'])].append(FlowLog)
+    return(flowlog_index)
 
-    return
 
-def delete_flowlog(VpcId, FlowLogId, actually_do_it, client, args, region):
-    if args.actually_do_it:
-        logger.debug("   deleting Flow Log:{}, region:{}, VPC:{}".format(FlowLogId,region,VpcId))
-        response = client.delete_flow_logs(
-             DryRun=not actually_do_it,
-             FlowLogIds=[FlowLogId]
-        )
-        if response.get('Unsuccessful'):
-            for failure in response['Unsuccessful']:
-                if failure.get('Error'):
-                    logger.error("Flow Log deletion failed, error:{}".format(failure['Error'].get('Message')))
-        else:
-            logger.info("Successfully deleted Flow Log:{}, region:{}, VPC:{}".format(FlowLogId,region,VpcId))
-    else:
-        logger.info("Would delete Flow Log:{}, region:{}, VPC:{}".format(FlowLogId,region,VpcId))
-    return
+def enable_flowlogs(VpcId,flowlog_index,args,region):
+    '''Work out what VpcId needs. Returns a list of VPCs to create a flow log in and a list of flow logs to delete'''
+    # checking for existing flow logs to our bucket
+    bucket = 'arn:aws:s3:::{}'.format(args.flowlog_bucket)
+    FlowLogs = flowlog_index.get((VpcId, bucket), [])
+    if not FlowLogs:
+        # Flow logs to other destinations don't count, we still need one to our bucket
+        return([VpcId], [])
+
+    to_delete = []
+
+    for FlowLog in FlowLogs:
+        logger.debug("   Flow Log ({}) already exist, region:{}, VPC:{}".format(FlowLog['FlowLogId'],region,VpcId))
+        if FlowLog['DeliverLogsStatus'] == 'FAILED':
+            logger.error("Flow Log ({}) failed, region:{}, VPC:{}, please check it".format(FlowLog['FlowLogId'],region,VpcId))
+            return([], [])
+
+        logger.debug("Flow Log ({}) is {} on {}\n   traffic type: {}\n   destination type: {}\n   destination: {}\n   log format: \n   {}".format(
+            FlowLog['FlowLogId'],
+            FlowLog['FlowLogStatus'],
+            FlowLog['ResourceId'],
+            FlowLog['TrafficType'],
+            FlowLog['LogDestinationType'],
+            FlowLog['LogDestination'],
+            FlowLog['LogFormat']
+        ))
+
+        difflist = []
+        if FlowLog['TrafficType'] != args.traffic_type:
+            difflist.append("Traffic type will change from {} to {}.".format(FlowLog['TrafficType'],args.traffic_type))
+
+        if difflist == []:
+            # No actions to perform here
+            continue
 
-def create_flowlog(VpcId,bucket,client,args,region):
-    # creating flow logs
-    if args.actually_do_it:
-        logger.debug("enabling Flow Log region:{}, VPC:{}".format(region,VpcId))
+        logger.info("Existing flow log will be terminated and new flow log created with these changes:\n\t{}\n".format(difflist))
+        # This runs in a region worker, so the user is asked (unless --force) once all the regions are planned
+        to_delete.append({'VpcId': VpcId, 'FlowLogId': FlowLog['FlowLogId'], 'Changes': difflist})
+
+    # One new flow log replaces however many we delete
+    return([VpcId] if to_delete else [], to_delete)
+
+def chunks(items, size):
+    '''Yield successive lists of up to size items'''
+    for i in range(0, len(items), size):
+        yield(items[i:i + size])
+
+
+def delete_flowlogs(to_delete, client, args, region):
+    '''Delete the (VpcId, FlowLogId) pairs in to_delete, FLOWLOG_BATCH_SIZE per call. Returns the set of VPCs where a delete failed'''
+    failed_vpcs = set()
+    if not to_delete:
+        return(failed_vpcs)
+    if not args.actually_do_it:
+        for VpcId, FlowLogId in to_delete:
+            logger.info("Would delete Flow Log:{}, region:{}, VPC:{}".format(FlowLogId,region,VpcId))
+        return(failed_vpcs)
+
+    vpc_for = dict((FlowLogId, VpcId) for VpcId, FlowLogId in to_delete)
+    for batch in chunks(list(vpc_for), FLOWLOG_BATCH_SIZE):
+        logger.debug("   deleting {} Flow Logs, region:{}".format(len(batch),region))
+        response = client.delete_flow_logs(FlowLogIds=batch)
+        failed = set()
+        for failure in response.get('Unsuccessful', []):
+            # For deletes the ResourceId is the flow log
+            FlowLogId = failure.get('ResourceId')
+            failed.add(FlowLogId)
+            failed_vpcs.add(vpc_for.get(FlowLogId))
+            logger.error("Flow Log:{} deletion failed, region:{}, VPC:{}, error:{}".format(FlowLogId,region,vpc_for.get(FlowLogId),failure.get('Error', {}).get('Message')))
+        for FlowLogId in batch:
+            if FlowLogId not in failed:
+                logger.info("Successfully deleted Flow Log:{}, region:{}, VPC:{}".format(FlowLogId,region,vpc_for[FlowLogId]))
+    return(failed_vpcs)
+
+
+def create_flowlogs(vpc_ids, bucket, traffic_type, client, args, region):
+    '''Create a flow log of traffic_type to bucket for each of vpc_ids, FLOWLOG_BATCH_SIZE VPCs per call'''
+    if not vpc_ids:
+        return
+    if not args.actually_do_it:
+        for VpcId in vpc_ids:
+            logger.info("Would Enable Flow Log region:{}, VPC:{}".format(region,VpcId))
+        return
+
+    for batch in chunks(vpc_ids, FLOWLOG_BATCH_SIZE):
+        logger.debug("enabling Flow Logs for {} VPCs, region:{}".format(len(batch),region))
         response = client.create_flow_logs(
-            ResourceIds=[VpcId],
+            ResourceIds=batch,
             ResourceType='VPC',
-            TrafficType=args.traffic_type,
+            TrafficType=traffic_type,
             LogDestinationType='s3',
             LogDestination=bucket
         )
-
-        if response.get('Unsuccessful'):
-            for unsuccess in response['Unsuccessful']:
-                if unsuccess.get('Error'):
-                    logger.error("Flow Log creation failed, error:{}".format(unsuccess['Error'].get('Message')))
-        elif response.get('FlowLogIds'):
-            logger.info("Successfully created Flow Logs:{}, region:{}, VPC:{}".format(response['FlowLogIds'][0],region,VpcId))
-    else:
-        logger.info("Would Enable Flow Log region:{}, VPC:{}".format(region,VpcId))
+        failed = set()
+        for unsuccess in response.get('Unsuccessful', []):
+            failed.add(unsuccess.get('ResourceId'))
+            logger.error("Flow Log creation failed, region:{}, VPC:{}, error:{}".format(region,unsuccess.get('ResourceId'),unsuccess.get('Error', {}).get('Message')))
+        for VpcId in batch:
+            if VpcId not in failed:
+                logger.info("Successfully created Flow Log, region:{}, VPC:{}".format(region,VpcId))
     return
 
 def get_regions(session, args):
@@ -165,10 +265,9 @@ def get_regions(session, args):
         return([args.region])
 
     # otherwise return all the regions, us-east-1 first
-    ec2 = session.client('ec2')
-    response = ec2.describe_regions()
+    regions = describe_regions(session, args)
     output = ['us-east-1']
-    for r in response['Regions']:
+    for r in regions:
         # return us-east-1 first, but dont return it twice
         if r['RegionName'] == "us-east-1":
             continue
@@ -176,7 +275,7 @@ def get_regions(session, args):
     return(output)
 
 
-def do_args():
+def do_args(argv=None, known_only=False):
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", help="print debugging info", action='store_true')
@@ -186,12 +285,30 @@ def do_args():
     parser.add_argument("--profile", help="Use this CLI profile (instead of default or env credentials)")
     parser.add_argument("--vpc-id", help="Only Process Specified VPC")
     parser.add_argument("--actually-do-it", help="Actually Perform the action", action='store_true')
-    parser.add_argument("--flowlog-bucket", help="S3 bucket to deposit logs to", required=True)
+    parser.add_argument("--flowlog-bucket", help="S3 bucket to deposit logs to")
     parser.add_argument("--traffic-type", help="The type of traffic to log", default='ALL', choices=['ACCEPT','REJECT','ALL'])
     parser.add_argument("--force", help="Perform flowlog replacement without prompt", action='store_true')
-
-    args = parser.parse_args()
-
+    parser.add_argument("--plan-file", help="Write the flow logs to create and replace to this JSON file, without prompting or changing anything")
+    parser.add_argument("--apply-plan", help="Apply a plan written by --plan-file, without prompting or looking for VPCs again")
+    parser.add_argument("--max-workers", help="Number of regions to process in parallel. Default is 10", type=int, default=10)
+    parser.add_argument("--cache", help="Cache inventory (regions, buckets, users, keys) on disk between runs", action='store_true')
+    parser.add_argument("--refresh-cache", help="Ignore and replace any cached inventory", action='store_true')
+    parser.add_argument("--no-cache", help="Do not use the inventory cache, even if AWS_FAST_FIXES_CACHE is set", action='store_true')
+
+    if known_only:
+        # We are running alongside other fixes (see aws-fast-fixes.py), so leave their options to them,
+        # handing back whatever we didn't recognize as well
+        args, leftovers = parser.parse_known_args(argv)
+    else:
+        args = parser.parse_args(argv)
+    if args.apply_plan:
+        if args.plan_file:
+            parser.error("--plan-file and --apply-plan can't be used together")
+    elif not args.flowlog_bucket:
+        parser.error("--flowlog-bucket is required unless --apply-plan is given")
+
+    if known_only:
+        return(args, leftovers)
     return(args)
 
 if __name__ == '__main__':
@@ -226,5 +343,6 @@ if __name__ == '__main__':
 
     try:
         main(args, logger)
+        log_stats(logger)
     except KeyboardInterrupt:
         exit(1)
\ No newline at end of file